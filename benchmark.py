@@ -0,0 +1,544 @@
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# -----------------------------
+
+ITUNES_NS = '{http://www.itunes.com/dtds/podcast-1.0.dtd}'
+
+# -----------------------------
+
+def peak_rss_mb():
+    # prefer VmHWM, ru_maxrss is inherited from the parent across fork+exec on Linux
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_synthetic_rss_dict(rng, n_episodes):
+    # mimics the etree_to_dict() output stored in the rss_dicts archive
+    filler = '<p>' + ' '.join(rng.choice(['lorem', 'ipsum', 'dolor', 'sit', 'amet']) for _ in range(150)) + '</p>'
+    items = []
+    for i in range(n_episodes):
+        items.append({
+            'title': f'Episode {i}',
+            'description': filler,
+            'pubDate': 'Wed, 01 Jan 2020 00:00:00 +0000',
+            'guid': {'@isPermaLink': 'false', '#text': f'{rng.getrandbits(64):x}'},
+            'enclosure': {'@url': f'https://example.com/{rng.getrandbits(64):x}.mp3', '@length': '1234567', '@type': 'audio/mpeg'},
+            f'{ITUNES_NS}duration': f'{rng.randint(0, 2):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}',
+        })
+    return {'rss': {'@version': '2.0', 'channel': {
+        'title': f'Podcast {rng.getrandbits(32):x}',
+        'description': filler,
+        'language': 'en',
+        f'{ITUNES_NS}author': 'Someone',
+        'item': items[0] if len(items) == 1 else items,
+    }}}
+
+
+def make_synthetic_archive(rss_dicts_name, n_chunks, feeds_per_chunk, max_episodes, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(os.path.dirname(rss_dicts_name), exist_ok=True)
+    for i in range(n_chunks):
+        chunk = {f'https://example.com/feed/{i}/{j}.xml': make_synthetic_rss_dict(rng, rng.randint(1, max_episodes))
+                 for j in range(feeds_per_chunk)}
+        with open(f'{rss_dicts_name}_{i}.json.gz', 'wb') as f:
+            f.write(gzip.compress(json.dumps(chunk).encode('utf-8')))
+
+
+def make_synthetic_feed_xml(rng, n_episodes):
+    filler = escape('<p>' + ' '.join(rng.choice(['lorem', 'ipsum', 'dolor', 'sit', 'amet']) for _ in range(150)) + '</p>')
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd">',
+             '<channel>',
+             f'<title>Podcast {rng.getrandbits(32):x}</title>',
+             f'<description>{filler}</description>',
+             '<language>en</language>',
+             '<itunes:author>Someone</itunes:author>']
+    for i in range(n_episodes):
+        lines += ['<item>',
+                  f'<title>Episode {i}</title>',
+                  f'<description>{filler}</description>',
+                  '<pubDate>Wed, 01 Jan 2020 00:00:00 +0000</pubDate>',
+                  f'<guid isPermaLink="false">{rng.getrandbits(64):x}</guid>',
+                  f'<enclosure url="https://example.com/{rng.getrandbits(64):x}.mp3" length="1234567" type="audio/mpeg"/>',
+                  f'<itunes:duration>{rng.randint(0, 2):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}</itunes:duration>',
+                  '</item>']
+    lines += ['</channel>', '</rss>']
+    return '\n'.join(lines)
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    # stand-in for a podcast host, serves self.server.fixtures[path] after self.server.latency seconds
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body = self.server.fixtures.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        range_header = self.headers.get('Range', '')
+        if self.headers.get('If-Range', etag) != etag:
+            range_header = ''  # changed since the partial download, send all of it
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        # single 'bytes=start-' or 'bytes=start-end' ranges, as sent when resuming downloads
+        if range_header.startswith('bytes='):
+            start, _, end = range_header[len('bytes='):].partition('-')
+            start, end = int(start), min(int(end) if end else len(body) - 1, len(body) - 1)
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+            body = body[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_fixtures(fixtures, latency=0.0, host='', port=0):
+    """Starts a local HTTP server in a background thread. Stop it with server.shutdown()."""
+    server = ThreadingHTTPServer((host, port), FixtureHandler)
+    server.daemon_threads = True
+    server.fixtures = fixtures
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_child(args):
+    # runs a single benchmark in a fresh process so peak RSS isn't shared between loaders
+    cmd = [sys.executable, os.path.abspath(__file__)] + args
+    out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+# -----------------------------
+
+def _run_loader(loader, rss_dicts_name):
+    start = time.time()
+    if loader == 'old':
+        # every chunk json.load()ed into one dict, as export_lists.py used to
+        from rss_dicts_utils import rss_dicts_paths
+        rss_dicts = {}
+        for path in rss_dicts_paths(rss_dicts_name):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                rss_dicts.update(json.load(f))
+        n_feeds = len(rss_dicts)
+    else:
+        from rss_dicts_utils import iter_rss_dicts
+        n_feeds = sum(1 for _ in iter_rss_dicts(rss_dicts_name))
+    elapsed = time.time() - start
+    print(json.dumps({'n_feeds': n_feeds, 'seconds': elapsed, 'peak_rss_mb': peak_rss_mb()}))
+
+
+def _run_feed_parser(parser, path):
+    from podcast_utils import etree_to_dict, parse_feed, ET
+    start = time.time()
+    if parser == 'old':
+        with open(path, 'r', encoding='utf-8') as f:
+            rss_dict = etree_to_dict(ET.XML(f.read()))
+        n_episodes = len(rss_dict['rss']['channel']['item'])
+    else:
+        n_episodes = len(parse_feed(path).episodes)
+    elapsed = time.time() - start
+    print(json.dumps({'n_episodes': n_episodes, 'seconds': elapsed, 'peak_rss_mb': peak_rss_mb()}))
+
+
+def bench_feed_parser(n_episodes_list):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_episodes in n_episodes_list:
+            path = os.path.join(tmp_dir, f'feed_{n_episodes}.xml')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(make_synthetic_feed_xml(random.Random(0), n_episodes))
+            print(f'{n_episodes} episodes ({os.path.getsize(path) / 1e6:.1f}MB):')
+            for parser in ['old', 'new']:
+                r = run_child(['_run_feed_parser', '--parser', parser, '--path', path])
+                print(f'  {parser:>4}: {r["seconds"] * 1000:.0f}ms, {r["n_episodes"] / r["seconds"]:.0f} episodes/s, peak RSS {r["peak_rss_mb"]:.0f}MB')
+
+
+def _legacy_duration_to_seconds(ep_duration):
+    # the per-episode parsing export_lists.py used before durations.py
+    ep_duration = ep_duration.replace(';', ':').replace(',', ':').replace('::', ':')
+    if ep_duration.count(':') == 2:
+        hr, mn, sec = ep_duration.split(':')
+        return float(hr) * 3600 + float(mn) * 60 + float(sec)
+    elif ep_duration.count(':') == 1:
+        mn, sec = ep_duration.split(':')
+        return float(mn) * 60 + float(sec)
+    return float(ep_duration)
+
+
+def bench_durations(n):
+    from durations import parse_duration, _parse_duration
+    from export_lists import strip_curly_brackets
+    rng = random.Random(0)
+    formats = {
+        'HH:MM:SS': lambda: f'{rng.randint(0, 3):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}',
+        'MM:SS': lambda: f'{rng.randint(0, 180)}:{rng.randint(0, 59):02d}',
+        'seconds': lambda: str(rng.randint(0, 10000)),
+        'typos': lambda: f'{rng.randint(0, 3)};{rng.randint(0, 59):02d},{rng.randint(0, 59):02d}',
+    }
+    for name, make in formats.items():
+        values = [make() for _ in range(n)]
+        start = time.time()
+        for v in values:
+            _legacy_duration_to_seconds(v)
+        legacy_secs = time.time() - start
+        _parse_duration.cache_clear()
+        start = time.time()
+        for v in values:
+            parse_duration(v)
+        memo_secs = time.time() - start
+        print(f'{name:>10}: legacy {n / legacy_secs / 1e6:.2f}M/s, parse_duration {n / memo_secs / 1e6:.2f}M/s')
+
+    keys = ['title', 'description', 'pubDate', 'guid', 'enclosure', ITUNES_NS + 'duration', ITUNES_NS + 'author'] * (n // 7)
+    start = time.time()
+    for k in keys:
+        strip_curly_brackets.__wrapped__(k)
+    uncached_secs = time.time() - start
+    start = time.time()
+    for k in keys:
+        strip_curly_brackets(k)
+    cached_secs = time.time() - start
+    print(f'{"keys":>10}: uncached {len(keys) / uncached_secs / 1e6:.2f}M/s, cached {len(keys) / cached_secs / 1e6:.2f}M/s')
+
+
+def _legacy_ascii_percent(text):
+    # the per-character loop podcast_utils.ascii_percent() used before text_features()
+    ascii_count = 0
+    for char in text:
+        if ord(char) < 128:
+            ascii_count += 1
+    return (ascii_count / len(text)) * 100
+
+
+def bench_text(n):
+    import numpy as np
+    from podcast_utils import ascii_percent, ascii_percents, text_features
+    rng = random.Random(0)
+    words = ['podcast', 'history', 'the', 'daily', 'show', 'weekly', 'news', 'radio', 'noticias', 'talk']
+    foreign_words = ['café', 'Müller', 'podcast日本語', 'ラジオ', 'новости']
+    # ~1 in 10 titles has a non-ASCII word
+    titles = ['  ' + ' '.join(rng.choice(foreign_words if rng.random() < 0.02 else words) for _ in range(rng.randint(1, 12))) + ' '
+              for _ in range(n)]
+
+    start = time.time()
+    legacy = [_legacy_ascii_percent(t) for t in titles]
+    legacy_secs = time.time() - start
+    start = time.time()
+    single = [ascii_percent(t) for t in titles]
+    single_secs = time.time() - start
+    start = time.time()
+    batch = ascii_percents(titles)
+    batch_secs = time.time() - start
+    assert np.allclose(legacy, single) and np.allclose(legacy, batch)
+    print(f'ascii_percent: legacy {n / legacy_secs / 1e6:.2f}M/s, ascii_percent {n / single_secs / 1e6:.2f}M/s, '
+          f'ascii_percents {n / batch_secs / 1e6:.2f}M/s')
+
+    # the title checks download_podcast() used to make, with three .strip() calls per title
+    start = time.time()
+    legacy = [_legacy_ascii_percent(t) < 95 or len(t.strip()) < 8 or len(t.strip()) > 80 for t in titles]
+    legacy_secs = time.time() - start
+    start = time.time()
+    features = text_features(titles)
+    batch = (features['ascii_percent'] < 95) | (features['n_chars'] < 8) | (features['n_chars'] > 80)
+    batch_secs = time.time() - start
+    print(f' title checks: legacy {n / legacy_secs / 1e6:.2f}M/s, text_features {n / batch_secs / 1e6:.2f}M/s '
+          f'({int(np.sum(batch != np.array(legacy)))} differ, legacy measures ASCII before stripping)')
+
+
+def bench_loaders(n_chunks, feeds_per_chunk, max_episodes):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rss_dicts_name = os.path.join(tmp_dir, 'rss_dicts', 'rss_dicts_chunk')
+        print(f'Writing synthetic archive ({n_chunks} chunks x {feeds_per_chunk} feeds)...')
+        make_synthetic_archive(rss_dicts_name, n_chunks, feeds_per_chunk, max_episodes)
+        for loader in ['old', 'new']:
+            r = run_child(['_run_loader', '--loader', loader, '--rss_dicts_name', rss_dicts_name])
+            print(f'{loader:>4}: {r["n_feeds"]} feeds, {r["n_feeds"] / r["seconds"]:.0f} feeds/s, peak RSS {r["peak_rss_mb"]:.0f}MB')
+
+def bench_fetcher(n_feeds, n_hosts, latency, max_in_flight):
+    import requests
+    from rss_fetcher import fetch_concurrently, make_session
+    rng = random.Random(0)
+    fixtures = {f'/feed/{j}.xml': make_synthetic_feed_xml(rng, 5) for j in range(n_feeds)}
+    server = serve_fixtures(fixtures, latency)
+    port = server.server_address[1]
+    # every 127.0.0.x address reaches the same server but counts as a different host
+    urls = [f'http://127.0.0.{j % n_hosts + 1}:{port}/feed/{j}.xml' for j in range(n_feeds)]
+    try:
+        start = time.time()
+        for url in urls:
+            requests.get(url, timeout=10).text
+        serial_secs = time.time() - start
+        print(f'  serial: {n_feeds / serial_secs:.1f} feeds/s')
+
+        session = make_session(max_in_flight)
+        start = time.time()
+        n_ok = 0
+        for url, text, e in fetch_concurrently(urls, lambda url: session.get(url, timeout=10).text,
+                                               max_in_flight=max_in_flight, host_rate=6000, host_burst=100):
+            n_ok += e is None
+        concurrent_secs = time.time() - start
+        print(f'  concurrent: {n_feeds / concurrent_secs:.1f} feeds/s ({n_ok}/{n_feeds} ok)')
+    finally:
+        server.shutdown()
+
+def make_fixture_podcast(rng, n_episodes, episode_bytes, base_url):
+    """Returns ({path: body}, feed_path) for a feed whose enclosures are random 'audio' files on the same server."""
+    fixtures = {}
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd">',
+             '<channel>', '<title>Fixture Podcast</title>', '<language>en</language>']
+    for i in range(n_episodes):
+        path = f'/audio/{i}.mp3'
+        fixtures[path] = rng.randbytes(episode_bytes)
+        lines += ['<item>', f'<title>Episode {i}</title>',
+                  f'<enclosure url="{base_url}{path}" length="{episode_bytes}" type="audio/mpeg"/>', '</item>']
+    lines += ['</channel>', '</rss>']
+    fixtures['/feed.xml'] = '\n'.join(lines)
+    return fixtures, '/feed.xml'
+
+def bench_downloader(n_episodes, episode_mb, latency, max_workers):
+    from podcast_utils import RSS_to_record
+    from episode_downloader import download_feed, episode_filenames, part_paths, make_session
+    fixtures = {}
+    server = serve_fixtures(fixtures, latency)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    new_fixtures, feed_path = make_fixture_podcast(random.Random(0), n_episodes, int(episode_mb * 2**20), base_url)
+    fixtures.update(new_fixtures)
+    total_mb = n_episodes * episode_mb
+    try:
+        record = RSS_to_record(base_url + feed_path)
+        for workers in sorted({1, max_workers}):
+            with tempfile.TemporaryDirectory() as out_dir:
+                start = time.time()
+                n_ok, n_failed, n_bytes = download_feed(record, out_dir, make_session(workers), max_workers=workers)
+                secs = time.time() - start
+                print(f'  {workers} workers: {n_ok} episodes ({n_failed} failed), {total_mb / secs:.1f}MB/s')
+
+        # resume: leave half of every episode behind as a .part file, only the rest should be transferred
+        with tempfile.TemporaryDirectory() as out_dir:
+            names = episode_filenames(record.episodes)
+            for i, name in enumerate(names):
+                body = fixtures[f'/audio/{i}.mp3']
+                part_path, validator_path = part_paths(os.path.join(out_dir, name))
+                with open(part_path, 'wb') as f:
+                    f.write(body[:len(body) // 2])
+                with open(validator_path, 'w') as f:
+                    f.write(f'"{hashlib.sha1(body).hexdigest()}"') # the fixture server's ETag
+            n_ok, n_failed, n_bytes = download_feed(record, out_dir, make_session(max_workers), max_workers=max_workers)
+            n_intact = sum(open(os.path.join(out_dir, name), 'rb').read() == fixtures[f'/audio/{i}.mp3']
+                           for i, name in enumerate(names) if os.path.exists(os.path.join(out_dir, name)))
+            print(f'  resume: transferred {n_bytes / 2**20:.1f}MB of {total_mb:.1f}MB, {n_intact}/{n_episodes} files intact')
+    finally:
+        server.shutdown()
+
+def bench_coordinator(n_feeds, n_workers, latency, lease_seconds, kill_after, timeout):
+    # n_workers local podcast_download.py processes lease feeds from one chunk_coordinator.py queue,
+    # each in its own directory like separate machines. The first one is killed after kill_after seconds,
+    # its leased feeds should expire and be downloaded by the others
+    import signal
+    import subprocess
+    from chunk_coordinator import WorkQueue, serve
+    fixtures = {}
+    server = serve_fixtures(fixtures, latency)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    rng = random.Random(0)
+    urls = []
+    for n in range(n_feeds):
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<rss version="2.0">', '<channel>', f'<title>Feed {n}</title>']
+        for i in range(3):
+            path = f'/audio/{n}_{i}.mp3'
+            fixtures[path] = rng.randbytes(100000)
+            lines += ['<item>', f'<title>Episode {i}</title>', f'<guid>{n}_{i}</guid>',
+                      f'<enclosure url="{base_url}{path}" length="100000" type="audio/mpeg"/>', '</item>']
+        lines += ['</channel>', '</rss>']
+        fixtures[f'/feed/{n}.xml'] = '\n'.join(lines)
+        urls.append(f'{base_url}/feed/{n}.xml')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'podcast_download.py')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue = WorkQueue(os.path.join(tmp_dir, 'coordinator.sqlite'), lease_seconds)
+        queue.add_chunk(0, urls, [3600.0] * n_feeds, [f'Feed {n}' for n in range(n_feeds)])
+        coordinator = serve(queue, '127.0.0.1', 0, heartbeat_interval=max(1.0, lease_seconds / 5))
+        workers = []
+        for i in range(n_workers):
+            worker_dir = os.path.join(tmp_dir, f'worker{i}')
+            os.makedirs(worker_dir)
+            workers.append(subprocess.Popen([sys.executable, script, f'--coordinator=http://127.0.0.1:{coordinator.server_address[1]}',
+                                             f'--worker_id=worker{i}', '--downloader=builtin', '--max_processes=2'],
+                                            cwd=worker_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        start = time.time()
+        killed = False
+        try:
+            while queue.remaining() and time.time() - start < timeout:
+                if kill_after is not None and not killed and time.time() - start >= kill_after and n_workers > 1:
+                    workers[0].send_signal(signal.SIGKILL)
+                    killed = True
+                time.sleep(0.5)
+            secs = time.time() - start
+            for worker in workers:
+                try:
+                    worker.wait(timeout=max(5.0, lease_seconds))
+                except subprocess.TimeoutExpired:
+                    worker.kill()
+            n_downloaded = sum(len(os.listdir(os.path.join(tmp_dir, f'worker{i}', 'podcasts_chunk_0')))
+                               for i in range(n_workers) if os.path.isdir(os.path.join(tmp_dir, f'worker{i}', 'podcasts_chunk_0')))
+            print(f'  {n_feeds - queue.remaining()}/{n_feeds} feeds finished in {secs:.1f}s'
+                  f'{" (worker0 killed after " + str(kill_after) + "s)" if killed else ""}, {n_downloaded} feed folders written')
+            for worker, totals in sorted(queue.worker_totals().items()):
+                print(f'  {worker}: {", ".join(f"{n} {status}" for status, n in sorted(totals.items()))}')
+        finally:
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.kill()
+            coordinator.shutdown()
+            queue.close()
+            server.shutdown()
+
+def make_synthetic_clips(out_dir, n_clips, clip_seconds, seed=0):
+    # short mp3 "episodes" of sine tones at random pitches, generated by ffmpeg itself
+    rng = random.Random(seed)
+    paths = []
+    for i in range(n_clips):
+        path = os.path.join(out_dir, f'clip_{i}.mp3')
+        source = f'sine=frequency={rng.randint(100, 2000)}:duration={clip_seconds}'
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', source,
+                        '-c:a', 'libmp3lame', '-b:a', '128k', '-y', path], check=True)
+        paths.append(path)
+    return paths
+
+def bench_compress(n_clips, clip_seconds, batch_sizes):
+    import shutil
+    from podcast_compress import convert_files_to_opus
+    if shutil.which('ffmpeg') is None:
+        print('ffmpeg not found, skipping')
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        clips_dir = os.path.join(tmp_dir, 'clips')
+        os.makedirs(clips_dir)
+        print(f'Generating {n_clips} clips of {clip_seconds}s...')
+        clips = make_synthetic_clips(clips_dir, n_clips, clip_seconds)
+        for batch_size in batch_sizes:
+            work_dir = os.path.join(tmp_dir, f'batch_{batch_size}')
+            shutil.copytree(clips_dir, work_dir)
+            paths = [os.path.join(work_dir, os.path.basename(clip)) for clip in clips]
+            start = time.time()
+            seconds = []
+            for i in range(0, len(paths), batch_size):
+                seconds += convert_files_to_opus(paths[i:i + batch_size], min_age=0)
+            elapsed = time.time() - start
+            n_ok = sum(s is not None for s in seconds)
+            print(f'  batch_size {batch_size:>3}: {n_clips / elapsed:.1f} files/s ({n_ok}/{n_clips} ok, '
+                  f'{sum(s or 0 for s in seconds) / elapsed:.0f}x realtime)')
+
+# -----------------------------
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = subparsers.add_parser('loaders', help='whole-chunk json.load() vs iter_rss_dicts() on a synthetic rss_dicts archive')
+    p.add_argument('--n_chunks', type=int, default=4)
+    p.add_argument('--feeds_per_chunk', type=int, default=2000)
+    p.add_argument('--max_episodes', type=int, default=50)
+
+    p = subparsers.add_parser('fetcher', help='serial requests.get() vs fetch_concurrently() against a local server')
+    p.add_argument('--n_feeds', type=int, default=200)
+    p.add_argument('--n_hosts', type=int, default=20)
+    p.add_argument('--latency', type=float, default=0.05, help='seconds the local server waits before responding')
+    p.add_argument('--max_in_flight', type=int, default=64)
+
+    p = subparsers.add_parser('feed_parser', help='etree_to_dict() vs parse_feed() on large synthetic feeds')
+    p.add_argument('--n_episodes', type=int, nargs='+', default=[1000, 10000])
+
+    p = subparsers.add_parser('_run_feed_parser')
+    p.add_argument('--parser', choices=['old', 'new'])
+    p.add_argument('--path')
+
+    p = subparsers.add_parser('durations', help='itunes:duration parsing and key normalisation micro-benchmarks')
+    p.add_argument('--n', type=int, default=200000)
+
+    p = subparsers.add_parser('downloader', help='episode_downloader.py throughput and Range resume against a local server')
+    p.add_argument('--n_episodes', type=int, default=20)
+    p.add_argument('--episode_mb', type=float, default=4.0)
+    p.add_argument('--latency', type=float, default=0.05, help='seconds the local server waits before responding')
+    p.add_argument('--max_workers', type=int, default=4)
+
+    p = subparsers.add_parser('coordinator', help='several local podcast_download.py workers leasing feeds from chunk_coordinator.py')
+    p.add_argument('--n_feeds', type=int, default=24)
+    p.add_argument('--n_workers', type=int, default=3)
+    p.add_argument('--latency', type=float, default=0.5, help='seconds the local server waits before responding')
+    p.add_argument('--lease_seconds', type=float, default=10.0)
+    p.add_argument('--kill_after', type=float, default=3.0, help='seconds before the first worker is killed, its leases must expire')
+    p.add_argument('--timeout', type=float, default=300.0)
+
+    p = subparsers.add_parser('text', help='per-character ascii_percent() loop vs batch text_features() on synthetic titles')
+    p.add_argument('--n', type=int, default=500000)
+
+    p = subparsers.add_parser('compress', help='one ffmpeg process per file vs batched ffmpeg on synthetic clips (needs ffmpeg)')
+    p.add_argument('--n_clips', type=int, default=64)
+    p.add_argument('--clip_seconds', type=float, default=5.0)
+    p.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32])
+
+    p = subparsers.add_parser('_run_loader')
+    p.add_argument('--loader', choices=['old', 'new'])
+    p.add_argument('--rss_dicts_name')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.benchmark == 'loaders':
+        bench_loaders(args.n_chunks, args.feeds_per_chunk, args.max_episodes)
+    elif args.benchmark == 'fetcher':
+        bench_fetcher(args.n_feeds, args.n_hosts, args.latency, args.max_in_flight)
+    elif args.benchmark == 'feed_parser':
+        bench_feed_parser(args.n_episodes)
+    elif args.benchmark == '_run_feed_parser':
+        _run_feed_parser(args.parser, args.path)
+    elif args.benchmark == 'durations':
+        bench_durations(args.n)
+    elif args.benchmark == 'downloader':
+        bench_downloader(args.n_episodes, args.episode_mb, args.latency, args.max_workers)
+    elif args.benchmark == 'coordinator':
+        bench_coordinator(args.n_feeds, args.n_workers, args.latency, args.lease_seconds, args.kill_after, args.timeout)
+    elif args.benchmark == 'text':
+        bench_text(args.n)
+    elif args.benchmark == 'compress':
+        bench_compress(args.n_clips, args.clip_seconds, args.batch_sizes)
+    elif args.benchmark == '_run_loader':
+        _run_loader(args.loader, args.rss_dicts_name)
@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import requests
+from feed_index import FeedIndex, FEED_INDEX_PATH
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# -----------------------------
+
+COORDINATOR_PATH = 'coordinator.sqlite'
+PORT = 8470
+
+LEASE_SECONDS = 600.0  # a leased feed goes back to the queue if its worker doesn't heartbeat for this long
+HEARTBEAT_INTERVAL = 60.0
+MAX_LEASES = 3  # a feed whose lease expired this many times is marked failed, it probably crashes its workers
+
+PENDING = 'pending'
+LEASED = 'leased'
+
+# -----------------------------
+
+class WorkQueue:
+    """
+    Feed-level work units from the TSV chunks, leased to downloader nodes.
+    A lease lasts lease_seconds and is extended by heartbeats, expired leases are handed out again.
+    Safe to share between threads.
+    """
+    def __init__(self, path=COORDINATOR_PATH, lease_seconds=LEASE_SECONDS):
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS units ('
+                              'id INTEGER PRIMARY KEY, chunk_id INTEGER, url TEXT UNIQUE, duration REAL, title TEXT, '
+                              'status TEXT, worker TEXT, lease_expires REAL, n_leases INTEGER, reason TEXT, n_bytes INTEGER)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS units_status ON units (status, chunk_id, id)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS units_expiry ON units (status, lease_expires)')
+
+    def add_chunk(self, chunk_id, urls, durations, titles):
+        """Adds a chunk's feeds, feeds that are already queued keep their state. Returns the number added."""
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT OR IGNORE INTO units (chunk_id, url, duration, title, status, n_leases) '
+                                  'VALUES (?, ?, ?, ?, ?, 0)',
+                                  ((chunk_id, url, duration, title, PENDING) for url, duration, title in zip(urls, durations, titles)))
+            self.conn.execute('COMMIT')
+            return self.conn.total_changes - before
+
+    def lease(self, worker, n, now=None):
+        """Returns up to n units as dicts, expired leases first, then the lowest pending chunks."""
+        now = time.time() if now is None else now
+        n = max(0, int(n)) # SQLite reads a negative LIMIT as no limit
+        if n == 0:
+            return []
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute('UPDATE units SET status = ?, reason = ? WHERE status = ? AND lease_expires < ? AND n_leases >= ?',
+                              ('failed', f'lease expired {MAX_LEASES} times', LEASED, now, MAX_LEASES))
+            rows = self.conn.execute('SELECT id, chunk_id, url, duration, title FROM units '
+                                     'WHERE status = ? AND lease_expires < ? LIMIT ?', (LEASED, now, n)).fetchall()
+            if len(rows) < n:
+                rows += self.conn.execute('SELECT id, chunk_id, url, duration, title FROM units '
+                                          'WHERE status = ? ORDER BY chunk_id, id LIMIT ?', (PENDING, n - len(rows))).fetchall()
+            self.conn.executemany('UPDATE units SET status = ?, worker = ?, lease_expires = ?, n_leases = n_leases + 1 WHERE id = ?',
+                                  ((LEASED, worker, now + self.lease_seconds, row[0]) for row in rows))
+            self.conn.execute('COMMIT')
+        return [dict(zip(['id', 'chunk_id', 'url', 'duration', 'title'], row)) for row in rows]
+
+    def heartbeat(self, worker, ids, now=None):
+        """Extends the worker's leases on ids. Returns the ids it no longer holds."""
+        now = time.time() if now is None else now
+        lost = []
+        with self.lock:
+            for unit_id in ids:
+                cursor = self.conn.execute('UPDATE units SET lease_expires = ? WHERE id = ? AND worker = ? AND status = ?',
+                                           (now + self.lease_seconds, unit_id, worker, LEASED))
+                if cursor.rowcount == 0:
+                    lost.append(unit_id)
+        return lost
+
+    def complete(self, worker, results, now=None):
+        """
+        Records [{'id', 'status', 'reason', 'n_bytes'}, ...] for units the worker holds, or that nobody holds
+        (its lease expired and the unit wasn't leased again). A unit leased to another worker keeps that lease.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('UPDATE units SET status = ?, reason = ?, n_bytes = ?, worker = ? WHERE id = ? '
+                                  'AND (status = ? OR (status = ? AND (worker = ? OR lease_expires < ?)))',
+                                  ((r['status'], r.get('reason'), r.get('n_bytes'), worker, r['id'], PENDING, LEASED, worker, now)
+                                   for r in results))
+            self.conn.execute('COMMIT')
+
+    def remaining(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM units WHERE status IN (?, ?)', (PENDING, LEASED)).fetchone()[0]
+
+    def status(self):
+        """Returns {chunk_id: {status: (n_feeds, duration)}}."""
+        with self.lock:
+            rows = self.conn.execute('SELECT chunk_id, status, COUNT(*), SUM(duration) FROM units GROUP BY chunk_id, status').fetchall()
+        chunks = {}
+        for chunk_id, status, n, duration in rows:
+            chunks.setdefault(chunk_id, {})[status] = (n, duration)
+        return chunks
+
+    def worker_totals(self):
+        """Returns {worker: {status: n_feeds}}, finished feeds count under the worker that reported them."""
+        with self.lock:
+            rows = self.conn.execute('SELECT worker, status, COUNT(*) FROM units WHERE worker IS NOT NULL GROUP BY worker, status').fetchall()
+        workers = {}
+        for worker, status, n in rows:
+            workers.setdefault(worker, {})[status] = n
+        return workers
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    # POST /lease {worker, n}, /heartbeat {worker, ids}, /complete {worker, results}, GET /status
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, obj, code=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json({'remaining': self.server.queue.remaining(), 'chunks': self.server.queue.status(),
+                            'workers': self.server.queue.worker_totals()})
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        queue = self.server.queue
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            worker = str(request['worker'])
+            if self.path == '/lease':
+                response = {'units': queue.lease(worker, int(request.get('n', 1))), 'remaining': queue.remaining(),
+                            'heartbeat_interval': self.server.heartbeat_interval}
+            elif self.path == '/heartbeat':
+                response = {'lost': queue.heartbeat(worker, [int(unit_id) for unit_id in request['ids']])}
+            elif self.path == '/complete':
+                results = [{'id': int(r['id']), 'status': str(r['status']), 'reason': r.get('reason'), 'n_bytes': r.get('n_bytes')}
+                           for r in request['results']]
+                queue.complete(worker, results)
+                response = {'remaining': queue.remaining()}
+            else:
+                self.send_json({'error': 'not found'}, 404)
+                return
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # malformed JSON, missing fields or fields of the wrong type
+            self.send_json({'error': f'bad request: {e!r}'}, 400)
+            return
+        self.send_json(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(queue, host='', port=PORT, heartbeat_interval=HEARTBEAT_INTERVAL):
+    """Starts the coordinator in a background thread. Stop it with server.shutdown()."""
+    server = ThreadingHTTPServer((host, port), CoordinatorHandler)
+    server.daemon_threads = True
+    server.queue = queue
+    server.heartbeat_interval = heartbeat_interval
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# -----------------------------
+
+class CoordinatorClient:
+    """
+    Downloader-side end of the coordinator: leases feeds, heartbeats the ones it holds from a background thread,
+    and reports results, keeping any it couldn't send to retry later.
+    Safe to share between threads.
+    """
+    def __init__(self, url, worker=None, timeout=30):
+        self.url = url.rstrip('/')
+        self.worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.held = set()  # leased unit ids not completed yet
+        self.lost = set()  # leased unit ids the coordinator gave to another node, their results are dropped
+        self.outbox = []  # results not sent yet
+        self.heartbeat_interval = HEARTBEAT_INTERVAL
+        self.remaining = None
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+
+    def post(self, path, payload):
+        response = self.session.post(self.url + path, json={'worker': self.worker, **payload}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def lease(self, n):
+        self.flush()
+        response = self.post('/lease', {'n': max(0, n)})
+        self.heartbeat_interval = response['heartbeat_interval']
+        self.remaining = response['remaining']
+        with self.lock:
+            self.held.update(unit['id'] for unit in response['units'])
+        return response['units']
+
+    def complete(self, unit_id, status, reason=None, n_bytes=None):
+        with self.lock:
+            self.held.discard(unit_id)
+            if unit_id in self.lost:
+                self.lost.discard(unit_id)
+                return # another node has it now, its result counts
+            self.outbox.append({'id': unit_id, 'status': status, 'reason': reason, 'n_bytes': n_bytes})
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            results, self.outbox = self.outbox, []
+        if not results:
+            return
+        try:
+            self.remaining = self.post('/complete', {'results': results})['remaining']
+        except (requests.RequestException, ValueError):
+            with self.lock:
+                self.outbox = results + self.outbox  # coordinator unreachable, send them with the next call
+
+    def heartbeat_loop(self):
+        last_beat = time.time()
+        while True:
+            # checked every second, the interval is only known after the first lease
+            time.sleep(1.0)
+            if time.time() - last_beat < self.heartbeat_interval:
+                continue
+            last_beat = time.time()
+            with self.lock:
+                ids = list(self.held)
+            try:
+                self.flush()
+                if ids:
+                    lost = self.post('/heartbeat', {'ids': ids})['lost']
+                    with self.lock:
+                        self.lost.update(unit_id for unit_id in lost if unit_id in self.held)
+            except (requests.RequestException, ValueError):
+                pass  # try again next interval, the leases last several intervals
+
+# -----------------------------
+
+def load_chunks(queue, start_chunk, final_chunk):
+    from podcast_download import read_chunk  # podcast_download imports this module for CoordinatorClient
+    # other spellings of a feed that's already queued aren't queued again
+    feed_index = FeedIndex(FEED_INDEX_PATH)
+    seen_feeds = set()
+    for chunk_id in range(start_chunk, final_chunk + 1):
+        chunk = read_chunk(chunk_id)
+        if chunk is None:
+            print(f"Chunk {chunk_id} not found, stopping")
+            break
+        is_duplicate = feed_index.mark_duplicates(chunk[0], seen_feeds)
+        urls, durations, titles = ([column[i] for i in range(len(column)) if not is_duplicate[i]] for column in chunk)
+        print(f"chunk {chunk_id}: added {queue.add_chunk(chunk_id, urls, durations, titles)} of {len(chunk[0])} feeds "
+              f"({sum(is_duplicate)} duplicates)")
+    feed_index.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start_chunk', type=int, required=True)
+    parser.add_argument('--final_chunk', type=int, required=True)
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--lease_seconds', type=float, default=LEASE_SECONDS)
+    parser.add_argument('--heartbeat_interval', type=float, default=HEARTBEAT_INTERVAL)
+    args = parser.parse_args()
+
+    queue = WorkQueue(COORDINATOR_PATH, args.lease_seconds)
+    load_chunks(queue, args.start_chunk, args.final_chunk)
+    server = serve(queue, args.host, args.port, args.heartbeat_interval)
+    print(f"Serving {queue.remaining()} feeds on port {server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"{queue.remaining()} feeds left")
+    finally:
+        server.shutdown()
+        queue.close()
@@ -0,0 +1,94 @@
+import os
+import time
+import sqlite3
+import threading
+from feed_index import canonical_url
+
+# -----------------------------
+
+COMPLETION_INDEX_PATH = 'completed.sqlite'
+
+DONE = 'done'
+SKIPPED = 'skipped'  # filtered out, e.g. not english
+FAILED = 'failed'  # retried with --retry_failed
+
+# -----------------------------
+
+class CompletionIndex:
+    """
+    Persistent status of every podcast feed podcast_download.py has processed,
+    keyed by feed_index.canonical_url(), with the reason for skips/failures and the bytes downloaded.
+    Safe to share between threads, and WAL mode lets several processes use the same file.
+    """
+    def __init__(self, path=COMPLETION_INDEX_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS completed ('
+                              'url TEXT PRIMARY KEY, status TEXT, reason TEXT, n_bytes INTEGER, updated REAL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.rekey()
+
+    def rekey(self):
+        """One-time rewrite of rows keyed by the old normalized URL (scheme kept, no feedburner folding) to canonical_url().
+        Where several rows become one feed, the most recently updated wins."""
+        with self.lock:
+            if self.conn.execute('SELECT 1 FROM meta WHERE key = ?', ('keys:canonical_url',)).fetchone():
+                return
+            self.conn.execute('BEGIN IMMEDIATE')
+            rows = self.conn.execute('SELECT * FROM completed ORDER BY updated').fetchall()
+            self.conn.execute('DELETE FROM completed')
+            self.conn.executemany('INSERT OR REPLACE INTO completed VALUES (?, ?, ?, ?, ?)',
+                                  ((canonical_url(url),) + tuple(rest) for url, *rest in rows))
+            self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('keys:canonical_url', str(time.time())))
+            self.conn.execute('COMMIT')
+
+    def migrate_completed_file(self, completed_file):
+        """One-time import of an old completed.txt, which didn't record why a feed was completed."""
+        if not os.path.exists(completed_file):
+            return 0
+        with self.lock:
+            if self.conn.execute('SELECT 1 FROM meta WHERE key = ?', ('migrated:' + completed_file,)).fetchone():
+                return 0
+        with open(completed_file, 'r') as f:
+            urls = set(canonical_url(line) for line in f if line.strip())
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT OR IGNORE INTO completed VALUES (?, ?, ?, ?, ?)',
+                                  ((url, DONE, 'imported from ' + completed_file, None, now) for url in urls))
+            self.conn.execute('INSERT INTO meta VALUES (?, ?)', ('migrated:' + completed_file, str(now)))
+            self.conn.execute('COMMIT')
+        return len(urls)
+
+    def get(self, url):
+        with self.lock:
+            row = self.conn.execute('SELECT status, reason, n_bytes, updated FROM completed WHERE url = ?',
+                                    (canonical_url(url),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['status', 'reason', 'n_bytes', 'updated'], row))
+
+    def is_finished(self, url, retry_failed=False):
+        # True if the feed shouldn't be downloaded again
+        entry = self.get(url)
+        return entry is not None and not (retry_failed and entry['status'] == FAILED)
+
+    def record(self, url, status, reason=None, n_bytes=None):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO completed VALUES (?, ?, ?, ?, ?)',
+                              (canonical_url(url), status, reason, n_bytes, time.time()))
+
+    def totals(self):
+        """Returns {status: (n_feeds, n_bytes)}."""
+        with self.lock:
+            rows = self.conn.execute('SELECT status, COUNT(*), COALESCE(SUM(n_bytes), 0) FROM completed GROUP BY status').fetchall()
+        return {status: (n, n_bytes) for status, n, n_bytes in rows}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,51 @@
+import math
+from functools import lru_cache
+
+import numpy as np
+
+# -----------------------------
+
+MAX_EPISODE_DURATION = 3600 * 8
+
+# -----------------------------
+
+# https://support.google.com/podcast-publishers/answer/9889544?hl=en#:~:text=Duration%20of%20the%20episode%2C%20in%20one%20of%20the%20following%20formats%3A
+def _fix_typos(ep_duration):
+    return ep_duration.replace(';', ':').replace(',', ':').replace('::', ':')
+
+
+@lru_cache(maxsize=1 << 18)
+def _parse_duration(ep_duration):
+    parts = _fix_typos(ep_duration).split(':')
+    if len(parts) > 3:
+        raise ValueError(f'ep_duration of "{ep_duration}" is not valid')
+    seconds = 0.0
+    try:
+        for part in parts:
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        raise ValueError(f'ep_duration of "{ep_duration}" is not valid') from None
+    if not math.isfinite(seconds):
+        raise ValueError(f'ep_duration of "{ep_duration}" is not valid')
+    return seconds
+
+
+def parse_duration(ep_duration):
+    """
+    '01:02:03' (HH:MM:SS), '62:03' (MM:SS) or '3723' (seconds) -> 3723.0
+    ';' and ',' typos are treated as ':'. Raises ValueError if the duration can't be parsed.
+    Results are memoized since most feeds reuse a small set of duration strings.
+    """
+    if not isinstance(ep_duration, str):
+        raise ValueError(f'ep_duration of "{ep_duration}" is not valid')
+    return _parse_duration(ep_duration)
+
+
+def is_valid_duration(seconds):
+    return 0.0 <= seconds <= MAX_EPISODE_DURATION
+
+
+def valid_duration_mask(seconds):
+    """Vectorized is_valid_duration(), NaN (missing) and -1.0 (unparseable) are both invalid."""
+    seconds = np.asarray(seconds)
+    return (seconds >= 0.0) & (seconds <= MAX_EPISODE_DURATION)
@@ -0,0 +1,164 @@
+import os
+import hashlib
+import concurrent.futures
+from os.path import exists
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from podcast_utils import make_path_safe
+from episode_index import existing_copy, link_episode, write_manifest
+
+# -----------------------------
+
+MAX_DOWNLOADS = 4  # episodes of one feed downloaded at once
+CHUNK_SIZE = 1 << 20  # bytes read from the connection per write
+REQUEST_TIMEOUT = 60
+
+AUDIO_EXTENSIONS = ['.mp3', '.m4a', '.mp4', '.wav', '.flac', '.ogg', '.opus', '.aac']
+
+# -----------------------------
+
+def make_session(max_connections=MAX_DOWNLOADS, retries=3):
+    # keep-alive connection pool with retries and backoff for flaky hosts
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=1.0, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def episode_key(episode):
+    # stable across runs, unlike the episode's position (feeds add new episodes at the top)
+    return hashlib.sha1((episode.guid or episode.enclosure_url or '').strip().encode('utf-8')).hexdigest()[:8]
+
+
+def episode_filenames(episodes):
+    """
+    Returns a file name per episode, from its title and enclosure extension, made unique within the feed.
+    Untitled episodes and titles used more than once get a suffix from episode_key(), so an episode keeps its name
+    when new episodes are added and never gets the name of another episode downloaded before.
+    """
+    bases = []
+    for episode in episodes:
+        ext = os.path.splitext(urlsplit(episode.enclosure_url).path)[1].lower()
+        bases.append((make_path_safe(episode.title or '')[:200], ext if ext in AUDIO_EXTENSIONS else '.mp3'))
+    n_titles = {}
+    for base, _ in bases:
+        n_titles[base.lower()] = n_titles.get(base.lower(), 0) + 1
+    names = []
+    used = set()
+    for episode, (base, ext) in zip(episodes, bases):
+        if not base:
+            base = f'episode [{episode_key(episode)}]'
+        elif n_titles[base.lower()] > 1:
+            base = f'{base} [{episode_key(episode)}]'
+        name = base + ext
+        n = 2
+        while name.lower() in used: # the same title and GUID twice, most likely the same episode listed twice
+            name = f'{base} ({n}){ext}'
+            n += 1
+        used.add(name.lower())
+        names.append(name)
+    return names
+
+
+def part_paths(path):
+    """(partial download, its validator), the validator is the ETag or Last-Modified of the response it came from."""
+    return path + '.part', path + '.part.validator'
+
+
+def response_validator(response):
+    # If-Range only accepts a strong ETag or a Last-Modified date
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def download_file(url, path, session=requests, chunk_size=CHUNK_SIZE, timeout=REQUEST_TIMEOUT):
+    """
+    Streams url to path + '.part' then renames it to path, so path only ever holds complete files.
+    A leftover .part from an interrupted download is resumed with an HTTP Range request, sent with If-Range
+    so the server sends the whole file again if it changed. A .part without a saved validator is started over.
+    Returns the number of bytes downloaded.
+    """
+    if exists(path):
+        return 0
+    part_path, validator_path = part_paths(path)
+    offset = 0
+    headers = {}
+    if exists(part_path) and exists(validator_path):
+        with open(validator_path, 'r', encoding='utf-8') as f:
+            validator = f.read().strip()
+        offset = os.path.getsize(part_path)
+        if offset and validator:
+            headers = {'Range': f'bytes={offset}-', 'If-Range': validator}
+        else:
+            offset = 0
+    n_bytes = 0
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416 and offset:
+            # nothing left after offset, the .part is already complete
+            os.replace(part_path, path)
+            os.remove(validator_path)
+            return 0
+        content_range = response.headers.get('Content-Range', '')
+        if response.status_code == 206 and offset and content_range.startswith(f'bytes {offset}-'):
+            mode = 'ab'
+        elif response.status_code == 200:
+            mode = 'wb'  # server ignored the Range header or the file changed, start again
+            with open(validator_path, 'w', encoding='utf-8') as f:
+                f.write(response_validator(response) or '')
+        else:
+            raise Exception(f"Error: {response.status_code} with {url}")
+        with open(part_path, mode) as f:
+            for block in response.iter_content(chunk_size):
+                f.write(block)
+                n_bytes += len(block)
+    os.replace(part_path, path)
+    os.remove(validator_path)
+    return n_bytes
+
+
+def download_feed(record, out_dir, session=None, max_workers=MAX_DOWNLOADS, episode_index=None):
+    """
+    Downloads every episode enclosure of an already parsed FeedRecord into out_dir,
+    max_workers at a time over one pooled session.
+    With an EpisodeIndex, episodes already downloaded for another feed are hardlinked from there instead,
+    or listed in out_dir's duplicates.tsv where hardlinks aren't possible, and new downloads are recorded in it.
+    Returns (n_downloaded, n_failed, n_bytes), episodes found in the index count as downloaded.
+    """
+    session = session or make_session(max_workers)
+    episodes = [episode for episode in record.episodes if episode.enclosure_url]
+    paths = [os.path.join(out_dir, name) for name in episode_filenames(episodes)]
+    n_downloaded = n_failed = n_bytes = 0
+    
+    todo = []
+    manifest = []
+    for episode, path in zip(episodes, paths):
+        existing = episode_index.find(episode) if episode_index is not None else None
+        if existing is None:
+            todo.append((episode, path))
+        elif existing_copy(path) is not None or link_episode(existing, path) is not None:
+            n_downloaded += 1  # already here (maybe converted to .opus), or hardlinked from another feed
+        else:
+            manifest.append((os.path.basename(path), existing))
+            n_downloaded += 1
+    write_manifest(out_dir, manifest)
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download_file, episode.enclosure_url, path, session): (episode, path)
+                   for episode, path in todo}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                n_bytes += future.result()
+                n_downloaded += 1
+            except Exception:
+                n_failed += 1
+                continue
+            if episode_index is not None:
+                episode_index.record(*futures[future])
+    return n_downloaded, n_failed, n_bytes
@@ -0,0 +1,123 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from os.path import exists
+from urllib.parse import urlsplit
+
+# -----------------------------
+
+EPISODE_INDEX_PATH = 'episode_index.sqlite'
+MANIFEST_NAME = 'duplicates.tsv'  # per podcast directory: episode file name, then the path it was downloaded to for another feed
+
+# analytics redirects put in front of the real enclosure URL, e.g. dts.podtrac.com/redirect.mp3/{host}/{path}
+TRACKING_PREFIX = re.compile(r'^(?:dts\.podtrac\.com/redirect\.\w+|www\.podtrac\.com/pts/redirect\.\w+|chtbl\.com/track/[^/]+'
+                             r'|chrt\.fm/track/[^/]+|pdst\.fm/e|op3\.dev/e[^/]*|pfx\.vpixl\.com/[^/]+|arttrk\.com/p/[^/]+'
+                             r'|verifi\.podscribe\.com/rss/p|mgln\.ai/e/[^/]+|prfx\.byspotify\.com/e|claritaspod\.com/measure)/'
+                             r'(?:https?:/{1,2})?', re.IGNORECASE)
+# query parameters that only track the listener, others (e.g. download.php?id=12) can be what identifies the episode
+TRACKING_PARAMS = re.compile(r'^(?:utm_\w*|updated|ts|fbclid|gclid|source|from|ref|awCollectionId|awEpisodeId)$', re.IGNORECASE)
+MIN_GUID_MATCH_LENGTH = 1 << 20  # enclosure bytes for a GUID match, feeds put placeholders like length="1" or "0"
+
+# -----------------------------
+
+def normalize_enclosure_url(url):
+    """
+    'https://dts.podtrac.com/redirect.mp3/Traffic.Megaphone.fm/ABC123.mp3?updated=1' -> 'traffic.megaphone.fm/ABC123.mp3'.
+    Tracking redirects, the scheme and tracking query parameters (TRACKING_PARAMS) are dropped, other parameters are kept.
+    """
+    url = url.strip()
+    if '://' in url:
+        url = url.split('://', 1)[1]
+    while True:
+        match = TRACKING_PREFIX.match(url)
+        if match is None:
+            break
+        url = url[match.end():]
+    parts = urlsplit('//' + url)
+    query = '&'.join(param for param in parts.query.split('&')
+                     if param and not TRACKING_PARAMS.match(param.split('=', 1)[0]))
+    return (parts.hostname or '') + parts.path + ('?' + query if query else '')
+
+
+def existing_copy(path):
+    """path if it exists, or the .opus podcast_compress.py replaced it with, otherwise None."""
+    for candidate in (path, os.path.splitext(path)[0] + '.opus'):
+        if exists(candidate):
+            return candidate
+    return None
+
+
+def link_episode(existing, path):
+    """
+    Hardlinks existing to path, keeping existing's extension (it may have been converted to .opus since).
+    Returns the path linked, or None if a hardlink isn't possible (another filesystem, or no hardlink support).
+    """
+    target = os.path.splitext(path)[0] + os.path.splitext(existing)[1]
+    if exists(target):
+        return target
+    try:
+        os.link(existing, target)
+    except OSError:
+        return None
+    return target
+
+
+def write_manifest(out_dir, entries):
+    """
+    Appends (file name, existing path) entries for duplicates that couldn't be hardlinked to out_dir's MANIFEST_NAME,
+    skipping file names it already lists (from an earlier run).
+    """
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    listed = set()
+    if exists(path):
+        with open(path, encoding='utf-8') as f:
+            listed = {line.split('\t', 1)[0] for line in f}
+    entries = [(name, existing) for name, existing in entries if name not in listed]
+    if entries:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.writelines(f'{name}\t{existing}\n' for name, existing in entries)
+
+
+class EpisodeIndex:
+    """
+    Persistent map from every episode downloaded by the builtin downloader to the path it was saved to,
+    keyed by normalized enclosure URL, and by GUID + enclosure length (networks syndicate the same episodes
+    into several feeds, sometimes with different tracking URLs).
+    Safe to share between threads, and WAL mode lets the download worker processes use the same file.
+    """
+    def __init__(self, path=EPISODE_INDEX_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS episodes ('
+                              'url_key TEXT PRIMARY KEY, guid TEXT, length INTEGER, path TEXT, added REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS episodes_guid ON episodes (guid, length)')
+
+    def find(self, episode):
+        """Returns an existing copy of episode downloaded before (see existing_copy()), or None."""
+        with self.lock:
+            rows = self.conn.execute('SELECT path FROM episodes WHERE url_key = ?',
+                                     (normalize_enclosure_url(episode.enclosure_url),)).fetchall()
+            if episode.guid and (episode.enclosure_length or 0) >= MIN_GUID_MATCH_LENGTH:
+                # a GUID alone isn't unique across feeds (e.g. '1', '2', ...), the same (real) byte length makes it the same file
+                rows += self.conn.execute('SELECT path FROM episodes WHERE guid = ? AND length = ?',
+                                          (episode.guid.strip(), episode.enclosure_length)).fetchall()
+        for (path,) in rows:
+            existing = existing_copy(path)
+            if existing is not None:
+                return existing
+        return None
+
+    def record(self, episode, path):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?, ?)',
+                              (normalize_enclosure_url(episode.enclosure_url), (episode.guid or '').strip() or None,
+                               episode.enclosure_length, path, time.time()))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
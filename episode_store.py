@@ -0,0 +1,296 @@
+import os
+import json
+import argparse
+from functools import lru_cache
+from email.utils import parsedate_to_datetime
+
+import numpy as np
+from tqdm import tqdm
+from durations import parse_duration, valid_duration_mask
+from rss_dicts_utils import RSS_DICTS_NAME, iter_rss_dicts
+
+# -----------------------------
+
+STORE_PATH = 'episode_store'
+
+# column name -> numpy dtype, 'str' (utf-8 blob + offsets) or 'category' (int32 codes + list of values)
+FEED_COLUMNS = {
+    'url': 'str',
+    'title': 'str',
+    'language': 'category',
+    'n_episodes': 'int32',
+}
+EPISODE_COLUMNS = {
+    'feed_id': 'int32',
+    'title': 'str',
+    'guid': 'str',
+    'pub_date': 'int64',  # unix seconds, -1 if missing/invalid
+    'duration_s': 'float32',  # NaN if missing, -1.0 if unparseable
+    'enclosure_url': 'str',
+    'enclosure_length': 'int64',  # bytes, -1 if missing/invalid
+}
+
+# -----------------------------
+
+class TableWriter:
+    """Appends rows to one table of a columnar store, one file per column, so writing takes constant memory."""
+    def __init__(self, table_dir, columns):
+        os.makedirs(table_dir, exist_ok=True)
+        self.table_dir = table_dir
+        self.columns = columns
+        self.n_rows = 0
+        self.files = {}
+        self.str_offsets = {}
+        self.categories = {}
+        for name, dtype in columns.items():
+            if dtype == 'str':
+                self.files[name] = open(os.path.join(table_dir, f'{name}.data.bin'), 'wb')
+                self.files[name + '.offsets'] = open(os.path.join(table_dir, f'{name}.offsets.bin'), 'wb')
+                np.zeros(1, dtype='<i8').tofile(self.files[name + '.offsets'])
+                self.str_offsets[name] = 0
+            else:
+                self.files[name] = open(os.path.join(table_dir, f'{name}.bin'), 'wb')
+                if dtype == 'category':
+                    self.categories[name] = {}
+
+    def append(self, rows):
+        """rows is a dict of column name -> list of values, all lists must be the same length."""
+        n = len(next(iter(rows.values())))
+        for name, dtype in self.columns.items():
+            values = rows[name]
+            assert len(values) == n, f'column {name} has {len(values)} values, expected {n}'
+            if dtype == 'str':
+                encoded = [(v or '').encode('utf-8', 'surrogatepass') for v in values]
+                self.files[name].write(b''.join(encoded))
+                offsets = np.cumsum([len(b) for b in encoded], dtype='<i8') + self.str_offsets[name]
+                offsets.tofile(self.files[name + '.offsets'])
+                if n:
+                    self.str_offsets[name] = int(offsets[-1])
+            elif dtype == 'category':
+                codes = self.categories[name]
+                np.array([codes.setdefault(v or '', len(codes)) for v in values], dtype='<i4').tofile(self.files[name])
+            else:
+                np.asarray(values, dtype=np.dtype(dtype).newbyteorder('<')).tofile(self.files[name])
+        self.n_rows += n
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        return {
+            'n_rows': self.n_rows,
+            'columns': self.columns,
+            'categories': {name: list(codes) for name, codes in self.categories.items()},
+        }
+
+
+class StringColumn:
+    """Read-only view of a 'str' column, decodes values on access."""
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8', 'surrogatepass')
+
+
+class CategoryColumn:
+    """Read-only view of a 'category' column. .codes is an int32 array indexing into .categories."""
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.categories[self.codes[i]]
+
+
+def _memmap(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def load_table(table_dir, meta):
+    table = {}
+    for name, dtype in meta['columns'].items():
+        if dtype == 'str':
+            table[name] = StringColumn(_memmap(os.path.join(table_dir, f'{name}.data.bin'), 'u1'),
+                                       _memmap(os.path.join(table_dir, f'{name}.offsets.bin'), '<i8'))
+        elif dtype == 'category':
+            table[name] = CategoryColumn(_memmap(os.path.join(table_dir, f'{name}.bin'), '<i4'),
+                                         meta['categories'][name])
+        else:
+            table[name] = _memmap(os.path.join(table_dir, f'{name}.bin'), np.dtype(dtype).newbyteorder('<'))
+    return table
+
+
+def load_store(path=STORE_PATH):
+    """Returns {'feeds': {column: array}, 'episodes': {column: array}}, columns are memory-mapped."""
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    return {table: load_table(os.path.join(path, table), table_meta) for table, table_meta in meta.items()}
+
+
+def n_failed_conversions(path=STORE_PATH):
+    """Number of feeds convert_rss_dicts() couldn't convert, these aren't in the store."""
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        return json.load(f)['feeds'].get('n_failed', 0)
+
+# -----------------------------
+
+@lru_cache(maxsize=None)
+def _strip_namespace(k):
+    # '{http://www.itunes.com/dtds/podcast-1.0.dtd}duration' -> 'duration'
+    return k.rsplit('}', 1)[-1]
+
+
+def _text(v):
+    # etree_to_dict() stores tags with attributes as {'@attr': ..., '#text': ...}
+    if isinstance(v, dict):
+        v = v.get('#text')
+    elif isinstance(v, list):
+        v = _text(v[0]) if v else None
+    return v if isinstance(v, str) else None
+
+
+def _pub_date_to_unix(pub_date):
+    try:
+        return int(parsedate_to_datetime(pub_date).timestamp())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return -1
+
+
+def _int_or(v, default):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return default
+
+
+def rss_dict_to_rows(rss_dict):
+    """
+    Extracts the feed fields and episode rows (without feed_id) from an etree_to_dict() feed.
+    Raises for the same malformed feeds export_lists.py counts as failed.
+    """
+    pod_dict = {_strip_namespace(k): v for k, v in rss_dict['rss']['channel'].items()}
+    feed = {'title': _text(pod_dict.get('title')), 'language': pod_dict['language'].strip()}
+    if 'description' not in pod_dict:
+        raise KeyError('description')
+    items = pod_dict['item']
+    if isinstance(items, dict):
+        items = [items]
+    elif isinstance(items, str):
+        items = [json.loads(items)]
+
+    episodes = []
+    for ep_dict in items:
+        ep_dict = {_strip_namespace(k): v for k, v in ep_dict.items()}
+        enclosure = ep_dict.get('enclosure')
+        if isinstance(enclosure, list):
+            enclosure = enclosure[0]
+        if not isinstance(enclosure, dict):
+            enclosure = {}
+        if 'duration' not in ep_dict:
+            duration = np.nan  # missing
+        else:
+            # unparseable, an empty <itunes:duration/> or a tag with attributes, export_lists.py rejects all of them
+            try:
+                duration = parse_duration(ep_dict['duration'])
+            except ValueError:
+                duration = -1.0
+        episodes.append((
+            _text(ep_dict.get('title')),
+            _text(ep_dict.get('guid')),
+            _pub_date_to_unix(_text(ep_dict.get('pubDate'))),
+            duration,
+            enclosure.get('@url'),
+            _int_or(enclosure.get('@length'), -1),
+        ))
+    feed['n_episodes'] = len(episodes)
+    return feed, episodes
+
+
+def convert_rss_dicts(out_path=STORE_PATH, rss_dicts_name=RSS_DICTS_NAME, batch_size=1000):
+    """One-time conversion of the rss_dicts_chunk_*.json.gz archive into a columnar store at out_path."""
+    feeds_writer = TableWriter(os.path.join(out_path, 'feeds'), FEED_COLUMNS)
+    episodes_writer = TableWriter(os.path.join(out_path, 'episodes'), EPISODE_COLUMNS)
+    feed_rows = {k: [] for k in FEED_COLUMNS}
+    episode_rows = {k: [] for k in EPISODE_COLUMNS}
+    n_failed = 0
+
+    def flush():
+        feeds_writer.append(feed_rows)
+        episodes_writer.append(episode_rows)
+        for rows in (feed_rows, episode_rows):
+            for k in rows:
+                rows[k] = []
+
+    for rss_link, rss_dict in tqdm(iter_rss_dicts(rss_dicts_name), desc='converting', smoothing=0.0):
+        try:
+            feed, episodes = rss_dict_to_rows(rss_dict)
+        except Exception:
+            n_failed += 1 # the same feeds export_lists.py counts as failed
+            continue
+        feed_id = feeds_writer.n_rows + len(feed_rows['url'])
+        feed_rows['url'].append(rss_link.strip())
+        for k, v in feed.items():
+            feed_rows[k].append(v)
+        for episode in episodes:
+            episode_rows['feed_id'].append(feed_id)
+            for k, v in zip(list(EPISODE_COLUMNS)[1:], episode):
+                episode_rows[k].append(v)
+        if len(feed_rows['url']) >= batch_size:
+            flush()
+    flush()
+
+    meta = {'feeds': feeds_writer.close(), 'episodes': episodes_writer.close()}
+    meta['feeds']['n_failed'] = n_failed # feeds that couldn't be converted, not in the store
+    with open(os.path.join(out_path, 'meta.json') + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(out_path, 'meta.json') + '.tmp', os.path.join(out_path, 'meta.json'))
+    print(f'Converted {meta["feeds"]["n_rows"]} feeds, {meta["episodes"]["n_rows"]} episodes, {n_failed} failed')
+    return meta
+
+# -----------------------------
+
+def feed_durations(store):
+    """
+    Returns (total_duration_s, failed) arrays with one value per feed, computed as a vectorized scan.
+    Like export_lists.py, a feed fails if any episode has an invalid (unparseable, negative or > 8h) duration.
+    """
+    feeds, episodes = store['feeds'], store['episodes']
+    n_feeds = len(feeds['url'])
+    feed_id = np.asarray(episodes['feed_id'])
+    duration = np.asarray(episodes['duration_s'], dtype=np.float64)
+    has_duration = ~np.isnan(duration)
+    valid = valid_duration_mask(duration)
+    total = np.bincount(feed_id, weights=np.where(valid, duration, 0.0), minlength=n_feeds)
+    failed = np.bincount(feed_id, weights=has_duration & ~valid, minlength=n_feeds) > 0
+    return total, failed
+
+
+def language_mask(store, substring='en'):
+    # evaluated once per distinct language instead of once per feed
+    language = store['feeds']['language']
+    matches = np.array([substring in c for c in language.categories], dtype=bool)
+    return matches[np.asarray(language.codes)] if len(language.categories) else np.zeros(len(language), dtype=bool)
+
+
+def english_feeds_over(store, min_duration_s=3600.0):
+    """Returns the feed ids of English feeds with at least min_duration_s of valid episodes."""
+    total, failed = feed_durations(store)
+    return np.flatnonzero(language_mask(store, 'en') & ~failed & (total >= min_duration_s))
+
+# -----------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rss_dicts_name', default=RSS_DICTS_NAME)
+    parser.add_argument('--out_path', default=STORE_PATH)
+    args = parser.parse_args()
+    convert_rss_dicts(args.out_path, args.rss_dicts_name)
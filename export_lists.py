@@ -1,38 +1,33 @@
-import gzip
+import zlib
 import json
 import math
+import heapq
 import time
 import os
 import random
+import argparse
+from glob import glob
+import traceback
+import concurrent.futures
+import numpy as np
+from functools import lru_cache
+from collections import Counter
 from tqdm import tqdm
+from durations import parse_duration, is_valid_duration
+from rss_dicts_utils import archive_paths, superseded_urls, iter_archive_file
+from episode_store import STORE_PATH, load_store, feed_durations, n_failed_conversions
+from feed_index import FeedIndex, FEED_INDEX_PATH
+from rss_fetcher import url_host
 
 # -----------------------------
 
 RSS_DICTS_NAME = 'rss_dicts/rss_dicts_chunk'
+MAX_DURATION_PER_CHUNK = 268435456.0 # 1TB @ 32kbps Opus
+CHUNK_STATS_PATH = 'podcast_tsv_chunks/chunk_stats.json'
 
 # -----------------------------
 
-def json_load_zipped(path):
-    with open(path, "rb") as f:
-        compressed_bytes = f.read()
-    json_bytes = gzip.decompress(compressed_bytes)
-    json_str = json_bytes.decode('utf-8')
-    d = json.loads(json_str)
-    return d
-
-def load(n_chunks='all'):
-    rss_dicts = {}
-    i = 0
-    while True:
-        path = f'{RSS_DICTS_NAME}_{i}.json.gz'
-        if not os.path.exists(path):
-            break
-        rss_dicts.update(json_load_zipped(path))
-        i += 1
-        if n_chunks != 'all' and i >= n_chunks:
-            break
-    return rss_dicts
-
+@lru_cache(maxsize=None) # the same few namespaced keys repeat on every feed and episode
 def strip_curly_brackets(s):
     # remove any curly bracket wrapped text from the string
     while True:
@@ -45,13 +40,127 @@ def strip_curly_brackets(s):
         s = s[:start] + s[end+1:]
     return s
 
+def feed_language_and_duration(rss_dict):
+    """Returns (language, total episode duration in seconds) of a feed, raises if the feed is malformed."""
+    pod_dict = rss_dict['rss']['channel']
+    pod_dict = {strip_curly_brackets(k): v for k, v in pod_dict.items()}
+    # keys = ['title', 'description', 'link', 'image', 'generator', 'lastBuildDate', 'author',
+    #         'copyright', 'language', 'summary', 'type', 'owner', 'explicit', 'category', 'item']
+
+    #pod_title     = pod_dict['title']
+    #pod_link      = pod_dict['link'] # sometimes missing
+    #pod_image_url = pod_dict['image'] # sometimes missing
+    #pod_copyright = pod_dict.get('copyright', None)
+    #pod_author    = pod_dict['author']
+    pod_language  = pod_dict['language'].strip() # 'en-us', raises for an empty tag (None) or one with attributes (dict)
+    pod_description = pod_dict['description']
+    if isinstance(pod_dict['item'], dict):
+        pod_dict['item'] = [pod_dict['item']]
+    elif isinstance(pod_dict['item'], str):
+        pod_dict['item'] = [json.loads(pod_dict['item'])]
+
+    pod_duration_sec = 0.0
+    for ep_dict in pod_dict['item']:
+        ep_dict = {strip_curly_brackets(k): v for k, v in ep_dict.items()}
+        # keys = ['title', 'description', 'link', 'guid', 'creator', 'pubDate', 'enclosure', 'summary',
+        #         'explicit', 'duration', 'image', 'season', 'episode', 'episodeType']
+
+        if 'duration' not in ep_dict:
+            continue
+
+        #ep_title    = ep_dict['title']
+        #ep_link     = ep_dict['link']
+        ep_duration = ep_dict['duration'] # '00:00:00' or '00:00'
+        #ep_pubDate  = ep_dict['pubDate']  # 'Wed, 01 Jan 2020 00:00:00 +0000'
+
+        ep_duration_sec = parse_duration(ep_duration) # memoized, handles '00:00:00', '00:00', seconds and typos
+        if not is_valid_duration(ep_duration_sec): # negative or longer than 8 hours
+            raise ValueError(f'ep_duration of "{ep_duration}" is not valid')
+        pod_duration_sec += ep_duration_sec
+    return pod_language, pod_duration_sec
+
+# urls left out of every legacy chunk (all the segments' urls), set once per worker process
+# so the set isn't sent along with each chunk
+_legacy_skip = frozenset()
+
+def set_legacy_skip(legacy_skip):
+    global _legacy_skip
+    _legacy_skip = legacy_skip
+
+def export_chunk(path, skip=None):
+    """
+    Returns ([(rss_link, language, duration_s), ...] for every feed over 1hr in one rss_dicts chunk or segment, n_failed).
+    Chunks are independent, so --workers runs this in separate processes. skip=None leaves out the set_legacy_skip() urls.
+    """
+    pod_rows = []
+    n_failed = 0
+    for rss_link, rss_dict in iter_archive_file(path, _legacy_skip if skip is None else skip):
+        try:
+            pod_language, pod_duration_sec = feed_language_and_duration(rss_dict)
+        except Exception as e:
+            traceback.print_exc()
+            n_failed += 1
+            continue
+        
+        if pod_duration_sec < 3600:
+            continue
+        pod_rows.append((rss_link, pod_language, pod_duration_sec))
+    return pod_rows, n_failed
+
+def plan_chunks(rows, max_duration_per_chunk=MAX_DURATION_PER_CHUNK):
+    """
+    Splits [(rss_link, duration_s, line), ...] into as few chunks as fit max_duration_per_chunk, with balanced durations:
+    longest feeds first, each into the chunk with the least duration so far (LPT bin packing).
+    Each chunk is then ordered by interleave_hosts(). Returns [[row, ...], ...].
+    """
+    total = sum(duration for _, duration, _ in rows)
+    n_chunks = max(1, math.ceil(total / max_duration_per_chunk))
+    chunks = [[] for _ in range(n_chunks)]
+    heap = [(0.0, i) for i in range(n_chunks)] # (duration, chunk index)
+    for row in sorted(rows, key=lambda row: (-row[1], row[0])):
+        duration, i = heapq.heappop(heap)
+        chunks[i].append(row)
+        heapq.heappush(heap, (duration + row[1], i))
+    return [interleave_hosts(chunk) for chunk in chunks if chunk]
+
+def interleave_hosts(rows):
+    """
+    Orders rows so each host's feeds are spread evenly over the chunk instead of in runs,
+    e.g. a host with half the feeds gets every other one, so the concurrent downloads hit different servers.
+    """
+    by_host = {}
+    for row in rows:
+        by_host.setdefault(url_host(row[0]), []).append(row)
+    # the k-th of a host's n feeds goes at (k + offset) / n of the way through the chunk, with a fixed offset
+    # per host so hosts with only a few feeds don't all land on the same spots (0.5, 0.25, ...)
+    keyed = [((k + (zlib.crc32(host.encode()) + 0.5) / 2**32) / len(host_rows), host, k)
+             for host, host_rows in by_host.items() for k in range(len(host_rows))]
+    return [by_host[host][k] for _, host, k in sorted(keyed)]
+
+def chunk_stats(chunk_id, rows, n_top_hosts=10):
+    hosts = Counter(url_host(row[0]) for row in rows)
+    return {
+        'chunk_id': chunk_id,
+        'n_feeds': len(rows),
+        'hours': round(sum(duration for _, duration, _ in rows) / 3600, 1),
+        'n_hosts': len(hosts),
+        'top_host_share': round(hosts.most_common(1)[0][1] / len(rows), 3) if rows else 0.0,
+        'hosts': dict(hosts.most_common(n_top_hosts)),
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', choices=['rss_dicts', 'store'], default='rss_dicts',
+                        help="'store' reads the columnar episode_store made by episode_store.py instead of rss_dicts")
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes exporting rss_dicts chunks in parallel, output is identical to --workers=1')
+    args = parser.parse_args()
+    return args.source, args.workers
+
 # -----------------------------
 
 if __name__ == '__main__':
-    
-    print('Loading rss_dicts...')
-    rss_dicts = load()
-    print('Done.')
+    source, workers = parse_args()
     
     n_english = 0
     n_non_english = 0
@@ -60,89 +169,57 @@ if __name__ == '__main__':
     non_english_duration = 0.0
     
     pod_tsv_list = [] # [f'{rss_link}\t{lang}\t{duration_s}' for rss_link, lang in rss_linklang]
+    pod_rows = [] # [(rss_link, lang, duration_s), ...]
     
-    for i, (rss_link, rss_dict) in enumerate(rss_dicts.items()):
-        if i < 0:
-            continue
+    if source == 'store':
+        # vectorized scan over the episodes table, only the feeds over 1hr are decoded
+        store = load_store(STORE_PATH)
+        durations, failed = feed_durations(store)
+        n_failed = int(failed.sum()) + n_failed_conversions(STORE_PATH)
+        for feed_id in np.flatnonzero(~failed & (durations >= 3600)):
+            pod_rows.append((store['feeds']['url'][feed_id], store['feeds']['language'][feed_id], float(durations[feed_id])))
+    else:
+        # stream one chunk at a time instead of loading every chunk into RAM,
+        # results are merged in chunk order so the output doesn't depend on --workers
+        paths = archive_paths(RSS_DICTS_NAME)
+        skip = superseded_urls(paths)
+        legacy_skip = next((skip[path] for path in paths if not path.endswith('.jsonl.gz')), frozenset())
+        skips = [skip[path] if path.endswith('.jsonl.gz') else None for path in paths]
+        set_legacy_skip(legacy_skip)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=set_legacy_skip,
+                                                          initargs=(legacy_skip,)) if workers > 1 else None
+        chunk_results = executor.map(export_chunk, paths, skips) if executor else map(export_chunk, paths, skips)
         try:
-            pod_dict = rss_dict['rss']['channel']
-            pod_dict = {strip_curly_brackets(k): v for k, v in pod_dict.items()}
-            # keys = ['title', 'description', 'link', 'image', 'generator', 'lastBuildDate', 'author',
-            #         'copyright', 'language', 'summary', 'type', 'owner', 'explicit', 'category', 'item']
-            
-            #pod_title     = pod_dict['title']
-            #pod_link      = pod_dict['link'] # sometimes missing
-            #pod_image_url = pod_dict['image'] # sometimes missing
-            #pod_copyright = pod_dict.get('copyright', None)
-            #pod_author    = pod_dict['author']
-            pod_language  = pod_dict['language'] # 'en-us'
-            pod_description = pod_dict['description']
-            if isinstance(pod_dict['item'], dict):
-                pod_dict['item'] = [pod_dict['item']]
-            elif isinstance(pod_dict['item'], str):
-                pod_dict['item'] = [json.loads(pod_dict['item'])]
-            
-            pod_duration_sec = 0.0
-            for ep_dict in pod_dict['item']:
-                ep_dict = {strip_curly_brackets(k): v for k, v in ep_dict.items()}
-                # keys = ['title', 'description', 'link', 'guid', 'creator', 'pubDate', 'enclosure', 'summary',
-                #         'explicit', 'duration', 'image', 'season', 'episode', 'episodeType']
-                
-                if 'duration' not in ep_dict:
-                    continue
-                
-                #ep_title    = ep_dict['title']
-                #ep_link     = ep_dict['link']
-                ep_duration = ep_dict['duration'] # '00:00:00' or '00:00'
-                #ep_pubDate  = ep_dict['pubDate']  # 'Wed, 01 Jan 2020 00:00:00 +0000'
-                
-                try: # https://support.google.com/podcast-publishers/answer/9889544?hl=en#:~:text=Duration%20of%20the%20episode%2C%20in%20one%20of%20the%20following%20formats%3A
-                    ep_duration = ep_duration.replace(';', ':').replace(',', ':').replace('::', ':') # fix basic typos
-                    if ep_duration.count(':') == 2:
-                        ep_duration_sec = 0.0
-                        hr, mn, sec = ep_duration.split(':')
-                        ep_duration_sec += float(hr) * 3600
-                        ep_duration_sec += float(mn) * 60
-                        ep_duration_sec += float(sec)
-                        pod_duration_sec += ep_duration_sec
-                    elif ep_duration.count(':') == 1:
-                        ep_duration_sec = 0.0
-                        mn, sec = ep_duration.split(':')
-                        ep_duration_sec += float(mn) * 60
-                        ep_duration_sec += float(sec)
-                        pod_duration_sec += ep_duration_sec
-                    else:
-                        ep_duration_sec = float(ep_duration)
-                    assert math.isfinite(ep_duration_sec), f'ep_duration is not finite: {ep_duration}'
-                    assert ep_duration_sec >= 0.0, f'ep_duration is negative: {ep_duration}'
-                    assert ep_duration_sec <= 3600*8, f'ep_duration is longer than 8 hours: {ep_duration}'
-                except:
-                    raise ValueError(f'ep_duration of "{ep_duration}" is not valid')
-            
-            if pod_duration_sec < 3600:
-                continue
-            
-            pod_tsv_list.append(f'{rss_link.strip()}\t{pod_language.strip()}\t{pod_duration_sec:.1f}')
-            
-            # custom code
-            if 'en' in pod_language:
-                n_english += 1
-                english_duration += pod_duration_sec
-            else:
-                n_non_english += 1
-                non_english_duration += pod_duration_sec
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            n_failed += 1
-            continue
+            for chunk_rows, chunk_n_failed in tqdm(chunk_results, total=len(paths), desc='exporting chunks', smoothing=0.0):
+                pod_rows += chunk_rows
+                n_failed += chunk_n_failed
         except KeyboardInterrupt:
-            break
+            pass
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    # the same feed under different URLs is only exported once, the first one in chunk order
+    feed_index = FeedIndex(FEED_INDEX_PATH)
+    is_duplicate = feed_index.mark_duplicates([rss_link.strip() for rss_link, _, _ in pod_rows])
+    n_duplicates = sum(is_duplicate)
+    pod_rows = [row for row, duplicate in zip(pod_rows, is_duplicate) if not duplicate]
+    
+    for rss_link, pod_language, pod_duration_sec in pod_rows:
+        pod_tsv_list.append(f'{rss_link.strip()}\t{pod_language}\t{pod_duration_sec:.1f}')
+        
+        # custom code
+        if 'en' in pod_language:
+            n_english += 1
+            english_duration += pod_duration_sec
+        else:
+            n_non_english += 1
+            non_english_duration += pod_duration_sec
     
     print(f'English: {n_english}')
     print(f'Non-English: {n_non_english}')
     print(f'Total: {n_english + n_non_english}')
     print(f'Failed: {n_failed}')
+    print(f'Duplicates: {n_duplicates}')
     print('')
     print(f'English Duration: {english_duration}')
     print(f'Non-English Duration: {non_english_duration}')
@@ -154,24 +231,37 @@ if __name__ == '__main__':
     completed_url_paths = ["feedurls_h/feedurls_rank01_h.txt", "feedurls_h/feedurls_rank09_h.txt"]
     completed_urls = set()
     for url_path in completed_url_paths:
+        if not os.path.exists(url_path):
+            continue
         with open(url_path, 'r') as f:
             for line in f.readlines():
                 completed_urls.add(line.strip())
+    # compared by feed, so another spelling of a completed feed is skipped too
+    completed_feeds = set(feed_index.feed_ids(completed_urls))
+    feed_ids = feed_index.feed_ids([rss_link.strip() for rss_link, _, _ in pod_rows])
+    feed_index.close()
     
-    max_duration_per_chunk = 268435456.0 # 1TB @ 32kbps Opus
-    pod_tsv_list_chunk = []
-    n_duration = 0
-    chunk_i = 0
-    for _ in pod_tsv_list:
+    # english feeds that aren't completed, bin-packed into chunks of about equal duration (the last one included)
+    # with each chunk's hosts interleaved
+    chunk_rows = []
+    for _, feed_id in zip(pod_tsv_list, feed_ids):
         rss_link, lang, duration_s = _.split('\t')
-        if rss_link in completed_urls:
+        if feed_id in completed_feeds:
             continue
         if 'en' in lang:
-            pod_tsv_list_chunk.append(_)
-            n_duration += float(duration_s)
-        if n_duration > max_duration_per_chunk:
-            with open(f'podcast_tsv_chunks/podcast_over1hr_english_chunk_{chunk_i}.tsv', 'w') as f:
-                f.write('\n'.join(pod_tsv_list_chunk))
-            pod_tsv_list_chunk = []
-            n_duration = 0
-            chunk_i += 1
\ No newline at end of file
+            chunk_rows.append((rss_link, float(duration_s), _))
+    
+    os.makedirs('podcast_tsv_chunks', exist_ok=True)
+    # the new plan can have fewer chunks with other feeds in each, so the previous plan's chunks
+    # and their prefilter.py _filtered lists are removed instead of being read by podcast_download.py
+    for path in glob('podcast_tsv_chunks/podcast_over1hr_english_chunk_*.tsv'):
+        os.remove(path)
+    stats = []
+    for chunk_i, rows in enumerate(plan_chunks(chunk_rows)):
+        with open(f'podcast_tsv_chunks/podcast_over1hr_english_chunk_{chunk_i}.tsv', 'w') as f:
+            f.write('\n'.join(line for _, _, line in rows))
+        stats.append(chunk_stats(chunk_i, rows))
+        print(f"chunk {chunk_i}: {stats[-1]['n_feeds']} feeds, {stats[-1]['hours']:.0f} hours, {stats[-1]['n_hosts']} hosts, "
+              f"{stats[-1]['top_host_share']:.0%} from the top host")
+    with open(CHUNK_STATS_PATH, 'w') as f:
+        json.dump(stats, f, indent=1)
@@ -0,0 +1,98 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+# -----------------------------
+
+FEED_CACHE_PATH = 'feed_cache.sqlite'
+
+# -----------------------------
+
+class FeedNotModified(Exception):
+    """Raised when a feed hasn't changed since it was last fetched."""
+
+
+class FeedCache:
+    """
+    Persistent per-feed validators (ETag, Last-Modified, content hash, last fetch time)
+    used to make conditional GET requests when re-crawling feeds.
+    Safe to share between threads.
+    """
+    def __init__(self, path=FEED_CACHE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS feeds ('
+                              'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_hash TEXT, last_fetch REAL)')
+
+    def get(self, url):
+        with self.lock:
+            row = self.conn.execute('SELECT etag, last_modified, content_hash, last_fetch FROM feeds WHERE url = ?',
+                                    (url,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['etag', 'last_modified', 'content_hash', 'last_fetch'], row))
+
+    def request_headers(self, url):
+        entry = self.get(url)
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def update(self, url, etag, last_modified, content_hash):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO feeds VALUES (?, ?, ?, ?, ?)',
+                              (url, etag, last_modified, content_hash, time.time()))
+
+    def update_many(self, entries):
+        """entries is [(url, (etag, last_modified, content_hash)), ...] as returned by conditional_get()."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT OR REPLACE INTO feeds VALUES (?, ?, ?, ?, ?)',
+                                  ((url, *validators, now) for url, validators in entries if validators is not None))
+            self.conn.execute('COMMIT')
+
+    def touch(self, url):
+        with self.lock:
+            self.conn.execute('UPDATE feeds SET last_fetch = ? WHERE url = ?', (time.time(), url))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def conditional_get(url, session, cache=None, revalidate=True, **kwargs):
+    """
+    session.get()'s url, sending the cached ETag/Last-Modified validators when revalidate is True.
+    Raises FeedNotModified on a 304 or when the body is identical to the last saved fetch, so callers can skip parsing.
+    Returns (response, validators), validators is None unless a cache is given and the response is a 200.
+    Nothing is recorded for a 200: pass validators to cache.update() once the feed is saved,
+    otherwise a crash or a parse error would leave the old copy looking up to date.
+    """
+    headers = cache.request_headers(url) if (cache is not None and revalidate) else {}
+    response = session.get(url, headers=headers, **kwargs)
+    if cache is None:
+        return response, None
+    if response.status_code == 304:
+        cache.touch(url)
+        raise FeedNotModified(url)
+    if response.status_code != 200:
+        return response, None
+
+    content_hash = hashlib.sha1(response.content).hexdigest()
+    entry = cache.get(url) if revalidate else None
+    if entry is not None and entry['content_hash'] == content_hash:
+        cache.touch(url)
+        raise FeedNotModified(url)
+    return response, (response.headers.get('ETag'), response.headers.get('Last-Modified'), content_hash)
@@ -0,0 +1,191 @@
+import hashlib
+import sqlite3
+import threading
+from urllib.parse import urlsplit
+
+# -----------------------------
+
+FEED_INDEX_PATH = 'feed_index.sqlite'
+
+FEEDBURNER_HOSTS = {'feeds.feedburner.com', 'feeds2.feedburner.com', 'feedproxy.google.com', 'feeds.feedburner.net'}
+FINGERPRINT_GUIDS = 3  # episodes (in feed order) whose GUIDs go into a channel fingerprint
+
+# -----------------------------
+
+def canonical_url(url):
+    """
+    '<HTTP://Feeds.FeedBurner.com/MyShow/?format=xml>' -> 'feeds.feedburner.com/myshow'.
+    A key for comparing feed URLs, not a URL to fetch: the scheme is dropped (http and https are the same feed),
+    the host is lowercased, default ports, fragments and trailing slashes are removed,
+    and feedburner's hosts, path case and format parameters are folded together.
+    """
+    url = url.strip().strip('<>"\'').strip()
+    if '://' not in url:
+        url = 'http://' + url
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url.lower()
+    host = (parts.hostname or '').rstrip('.')
+    path = parts.path.rstrip('/')
+    query = parts.query
+    if host in FEEDBURNER_HOSTS:
+        host, path, query = 'feeds.feedburner.com', path.lower(), ''
+    if port not in (None, 80, 443):
+        host += f':{port}'
+    return host + path + ('?' + query if query else '')
+
+
+def channel_fingerprint(title, guids):
+    """Hash of a channel's title and first episode GUIDs, None if there are no GUIDs (a title alone isn't unique)."""
+    guids = [guid.strip() for guid in guids if guid and guid.strip()][:FINGERPRINT_GUIDS]
+    if not title or not guids:
+        return None
+    return hashlib.sha1('\n'.join([' '.join(title.lower().split())] + guids).encode('utf-8')).hexdigest()
+
+
+def rss_dict_fingerprint(rss_dict):
+    """channel_fingerprint() of a feed parsed by load_rss_links.py's etree_to_dict(), None if it's malformed."""
+    try:
+        channel = rss_dict['rss']['channel']
+        items = channel.get('item', [])
+        items = [items] if isinstance(items, dict) else items
+        guids = []
+        for item in items[:FINGERPRINT_GUIDS]:
+            guid = item.get('guid') if isinstance(item, dict) else None
+            guid = guid.get('#text') if isinstance(guid, dict) else guid
+            if isinstance(guid, str):
+                guids.append(guid)
+        title = channel.get('title')
+        return channel_fingerprint(title if isinstance(title, str) else None, guids)
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+class FeedIndex:
+    """
+    Persistent map from every raw feed URL seen to a canonical feed ID.
+    URLs with the same canonical_url() are the same feed, and merge() joins feeds found to be the same in other ways
+    (a redirect to another feed's URL, or the same channel fingerprint). A feed ID is the canonical_url() of one
+    of its URLs, and can change when its feed is merged, so only compare IDs looked up around the same time.
+    Safe to share between threads, and WAL mode lets several processes use the same file.
+    """
+    def __init__(self, path=FEED_INDEX_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS urls (raw TEXT PRIMARY KEY, key TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS urls_key ON urls (key)')
+            # union-find with every key pointing straight at its root, merges relabel the smaller feed
+            self.conn.execute('CREATE TABLE IF NOT EXISTS feeds (key TEXT PRIMARY KEY, root TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS feeds_root ON feeds (root)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS fingerprints (fingerprint TEXT PRIMARY KEY, key TEXT)')
+
+    def _add(self, url):
+        # call with the lock held
+        key = canonical_url(url)
+        row = self.conn.execute('SELECT root FROM feeds WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.conn.execute('INSERT INTO feeds VALUES (?, ?)', (key, key))
+        self.conn.execute('INSERT OR IGNORE INTO urls VALUES (?, ?)', (url, key))
+        return key if row is None else row[0]
+
+    def feed_ids(self, urls):
+        """Returns the feed ID of every url, adding the ones not seen before."""
+        with self.lock:
+            self.conn.execute('BEGIN')
+            ids = [self._add(url) for url in urls]
+            self.conn.execute('COMMIT')
+        return ids
+
+    def feed_id(self, url):
+        return self.feed_ids([url])[0]
+
+    def mark_duplicates(self, urls, seen=None):
+        """
+        Returns [is_duplicate, ...] for urls: True if an earlier url is the same feed, or its feed ID is in seen.
+        The feed IDs of the other urls are added to seen, so it can be passed again for the next batch.
+        """
+        seen = set() if seen is None else seen
+        duplicates = []
+        for feed_id in self.feed_ids(urls):
+            duplicates.append(feed_id in seen)
+            seen.add(feed_id)
+        return duplicates
+
+    def merge(self, url_a, url_b):
+        """Records that url_a and url_b are the same feed. Returns its feed ID."""
+        with self.lock:
+            self.conn.execute('BEGIN')
+            root_a, root_b = self._add(url_a), self._add(url_b)
+            root = self._union(root_a, root_b)
+            self.conn.execute('COMMIT')
+        return root
+
+    def _union(self, root_a, root_b):
+        # call with the lock held, in a transaction
+        if root_a == root_b:
+            return root_a
+        size_a = self.conn.execute('SELECT COUNT(*) FROM feeds WHERE root = ?', (root_a,)).fetchone()[0]
+        size_b = self.conn.execute('SELECT COUNT(*) FROM feeds WHERE root = ?', (root_b,)).fetchone()[0]
+        keep, drop = (root_a, root_b) if size_a >= size_b else (root_b, root_a)
+        self.conn.execute('UPDATE feeds SET root = ? WHERE root = ?', (keep, drop))
+        return keep
+
+    def merge_redirect(self, url, target, fingerprint):
+        """
+        Merges url with the feed it redirected to, if target is a URL of a feed seen before or the channel served
+        has the fingerprint of a known feed. Call it only once the response parsed as a feed: hosting companies
+        redirect unrelated feeds to the same landing page, so the redirect alone isn't enough. Returns url's feed ID.
+        """
+        with self.lock:
+            self.conn.execute('BEGIN')
+            known = self.conn.execute('SELECT 1 FROM feeds WHERE key = ?', (canonical_url(target),)).fetchone() is not None
+            row = None
+            if fingerprint is not None:
+                row = self.conn.execute('SELECT key FROM fingerprints WHERE fingerprint = ?', (fingerprint,)).fetchone()
+            root = self._add(url)
+            if known or row is not None:
+                root = self._union(self._add(target), root)
+            if row is not None:
+                other = self.conn.execute('SELECT root FROM feeds WHERE key = ?', (row[0],)).fetchone()[0]
+                root = self._union(other, root)
+            self.conn.execute('COMMIT')
+        return root
+
+    def add_fingerprint(self, url, fingerprint):
+        """Merges url's feed with any feed seen before with the same channel fingerprint. Returns its feed ID."""
+        with self.lock:
+            self.conn.execute('BEGIN')
+            root = self._add(url)
+            if fingerprint is not None:
+                row = self.conn.execute('SELECT key FROM fingerprints WHERE fingerprint = ?', (fingerprint,)).fetchone()
+                if row is None:
+                    self.conn.execute('INSERT INTO fingerprints VALUES (?, ?)', (fingerprint, canonical_url(url)))
+                else:
+                    other = self.conn.execute('SELECT root FROM feeds WHERE key = ?', (row[0],)).fetchone()[0]
+                    root = self._union(other, root)
+            self.conn.execute('COMMIT')
+        return root
+
+    def aliases(self, url):
+        """Every raw URL seen for url's feed, url included."""
+        root = self.feed_id(url)
+        with self.lock:
+            rows = self.conn.execute('SELECT urls.raw FROM urls JOIN feeds ON urls.key = feeds.key WHERE feeds.root = ?',
+                                     (root,)).fetchall()
+        return [row[0] for row in rows]
+
+    def totals(self):
+        """Returns (n_urls, n_feeds)."""
+        with self.lock:
+            n_urls = self.conn.execute('SELECT COUNT(*) FROM urls').fetchone()[0]
+            n_feeds = self.conn.execute('SELECT COUNT(DISTINCT root) FROM feeds').fetchone()[0]
+        return n_urls, n_feeds
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -2,15 +2,32 @@ import requests
 import json
 import time
 import os
+import sys
+import argparse
+import threading
 from tqdm import tqdm
+from requests.adapters import HTTPAdapter
+from rss_fetcher import TokenBucket
+from feed_index import FeedIndex, FEED_INDEX_PATH
 
 
-def load_podcast_search(term):
+class SourceAddressAdapter(HTTPAdapter):
+    # sends every request from the given local IP, so each source IP gets its own iTunes rate limit
+    def __init__(self, source_address, **kwargs):
+        self.source_address = (source_address, 0)
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['source_address'] = self.source_address
+        super().init_poolmanager(*args, **kwargs)
+
+
+def load_podcast_search(term, session=requests):
     url = f"https://itunes.apple.com/search?media=podcast&entity=podcast&attribute=titleTerm&limit=200&term={term}"
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
     }
-    response = requests.get(url, headers=headers)
+    response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
     code = response.status_code
     if code == 200:
         data = json.loads(response.text)
@@ -22,97 +39,299 @@ def load_podcast_search(term):
 
 # -----------------------------
 
-MAX_REQUEST_RATE = 20  # max requests per minute, itunes api has a limit of 'approximately' 20
+MAX_REQUEST_RATE = 20  # max requests per minute per source IP, itunes api has a limit of 'approximately' 20
+REQUEST_TIMEOUT = 30
+
+RESULTS_PATH = 'podcast_search_results_full.json' # compacted JSON list read by load_rss_links.py
+RESULTS_LOG_PATH = 'podcast_search_results.jsonl' # append-only log, one result per line
+TERM_PATH = 'current_term.txt' # only read to resume crawls started before search_queue.json existed
+QUEUE_PATH = 'search_queue.json'
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz'
+
+# -----------------------------
+
+def pending_from_term(term):
+    # the old crawler walked the trie depth first, so everything after `term` is still to do
+    # e.g: 'abc' -> ['abc', 'abd', ..., 'abz', 'ac', ..., 'az', 'b', ..., 'z']
+    pending = [term]
+    while term:
+        pending += [term[:-1] + c for c in ALPHABET if c > term[-1]]
+        term = term[:-1]
+    return pending
+
+
+class PrefixQueue:
+    """
+    The search-term trie as an explicit work queue.
+    'a' -> if 'a' returns the maximum of 200 results, its children 'aa' ... 'az' are queued, since there are more results than we can see yet.
+    A prefix stays pending until it's done, so after a crash every pending prefix is searched again.
+    Safe to share between threads.
+    """
+    def __init__(self, path=QUEUE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.in_progress = set()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                state = json.load(f)
+        elif os.path.exists(TERM_PATH):
+            state = {'pending': pending_from_term(open(TERM_PATH, 'r').read().strip()), 'n_done': 0, 'failed': []}
+        else:
+            state = {'pending': list(ALPHABET), 'n_done': 0, 'failed': []}
+        self.pending = dict.fromkeys(state['pending']) # dict as an ordered set
+        self.n_done = state['n_done']
+        self.failed = state['failed']
+
+    def take(self):
+        """Returns a pending prefix no other worker is searching, or None."""
+        with self.lock:
+            for term in self.pending:
+                if term not in self.in_progress:
+                    self.in_progress.add(term)
+                    return term
+        return None
+
+    def done(self, term, n_responses):
+        with self.lock:
+            if n_responses >= 200:
+                self.pending.update(dict.fromkeys(term + c for c in ALPHABET))
+            del self.pending[term]
+            self.in_progress.discard(term)
+            self.n_done += 1
+
+    def give_up(self, term):
+        with self.lock:
+            self.failed.append(term)
+            del self.pending[term]
+            self.in_progress.discard(term)
+
+    def finished(self):
+        with self.lock:
+            return not self.pending
+
+    def snapshot(self):
+        with self.lock:
+            return {'pending': list(self.pending), 'n_done': self.n_done, 'failed': list(self.failed)}
+
+    def save(self, state=None):
+        state = self.snapshot() if state is None else state
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def iter_results(path=RESULTS_LOG_PATH):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                pass # last line cut short by a crash
+
+
+class ResultsLog:
+    """
+    Append-only JSONL log of search results with an in-memory trackId index,
+    so each save only writes the results found since the last one.
+    Safe to share between threads.
+    """
+    def __init__(self, path=RESULTS_LOG_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.unsaved = []
+        self.ids = set()
+        if not os.path.exists(path) and os.path.exists(RESULTS_PATH):
+            # one-time migration from the old results file, which can have the same trackId more than once
+            with open(RESULTS_PATH, 'r') as f:
+                for result in json.load(f):
+                    self.add(result)
+            self.flush()
+        self.truncate_partial_line()
+        self.ids = set(result['trackId'] for result in iter_results(path)) # rebuild dedup index from the log
+
+    def truncate_partial_line(self):
+        # a crash mid-write can leave half a line at the end, which the next append would corrupt
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            while end > 0:
+                f.seek(max(0, end - 4096))
+                block = f.read(end - max(0, end - 4096))
+                newline = block.rfind(b'\n')
+                if newline != -1:
+                    end = max(0, end - 4096) + newline + 1
+                    break
+                end = max(0, end - 4096)
+            f.truncate(end)
+
+    def __len__(self):
+        return len(self.ids)
 
-RESULTS_PATH = 'podcast_search_results_full.json'
-TERM_PATH = 'current_term.txt'
+    def add(self, result):
+        with self.lock:
+            if result['trackId'] in self.ids:
+                return
+            self.ids.add(result['trackId'])
+            self.unsaved.append(json.dumps(result) + '\n')
 
-results = json.loads(open(RESULTS_PATH, 'r').read()) if os.path.exists(RESULTS_PATH) else []
-result_ids = set()
+    def flush(self):
+        with self.lock:
+            lines, self.unsaved = self.unsaved, []
+            if not lines:
+                return
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
 
-term = open(TERM_PATH, 'r').read() if os.path.exists(TERM_PATH) else 'a'
+
+def compact_results(log_path=RESULTS_LOG_PATH, out_path=RESULTS_PATH):
+    """Writes the log as the single JSON list load_rss_links.py reads, one result at a time."""
+    n_results = 0
+    with open(out_path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write('[')
+        for result in iter_results(log_path):
+            f.write(', ' if n_results else '')
+            json.dump(result, f)
+            n_results += 1
+        f.write(']')
+    os.replace(out_path + '.tmp', out_path)
+    return n_results
 
 
 def save_results():
-    with open(RESULTS_PATH + '.tmp', 'w') as f:
-        json.dump(results, f)
-    os.replace(RESULTS_PATH + '.tmp', RESULTS_PATH)
-    with open(TERM_PATH + '.tmp', 'w') as f:
-        f.write(term)
-    os.replace(TERM_PATH + '.tmp', TERM_PATH)
-
-
-min_time_between_requests = 60.0 / MAX_REQUEST_RATE
-last_request_time = 0.0
-n_exceptions = 0
-counter = 0
-done = False
-pbar = tqdm(total=26**2)
-while not done:
-    
-    # wait for time between requests
-    time_since_last_request = time.time() - last_request_time
-    if time_since_last_request < min_time_between_requests:
-        time.sleep(min_time_between_requests - time_since_last_request)
-    
-    response_dict = None
-    while response_dict is None:
-        try:
-            last_request_time = time.time()
-            response_dict = load_podcast_search(term)
-            for result in response_dict['results']:
-                if result['trackId'] not in result_ids:
-                    result_ids.add(result['trackId'])
-                    results.append(result)
-            n_exceptions = 0
-        except Exception as e:
-            # if we get an exception, wait a bit and try again
-            
-            if n_exceptions > 5:  # if we get 6 exceptions in a row,
-                # print stacktrace and give up on this term
-                import traceback
-                
-                traceback.print_exc()
-                n_exceptions -= 1
-                break
-            
-            time.sleep(2 ** n_exceptions)  # exponential backoff
-            n_exceptions += 1
-        except KeyboardInterrupt:
-            raise KeyboardInterrupt
-    
-    # set next term
-    n_responses = len(response_dict['results'])
-    tqdm.write(f"term: \"{term}\" has {n_responses} results")
-    old_term = term # save old term for progress bar
-    if n_responses >= 200: # if we got the maximum number of results, increase how specific the search is
-        term += 'a'
-    else: # otherwise, increment the last character
-        term = term[:-1] + chr(ord(term[-1]) + 1)  # increment last character
-        # if we've reached the end of the alphabet, go up a level and increment the new last character
-        while term.endswith('{') and not done:
-            term = term[:-1]
-            if term == '':
-                done = True
-                break
-            term = term[:-1] + chr(ord(term[-1]) + 1)
-    # e.g:
-    # if 'aa' returned under 200 results: 'aa' -> 'ab'
-    # but 'aa' -> 'aaa' if 'aa' has more results then we can see yet
-    # there's also special case where 'aaz' -> 'ab' because there is no char after 'z'
-    
-    # dumb pbar to show progress (I can implement a proper pbar if someone cares)
-    if f'{old_term} '[1] != f'{term} '[1]:
+    # the queue state is taken before the results are written, workers add a prefix's results before marking it done,
+    # so a prefix saved as done always has its results saved too
+    with save_lock:
+        state = queue.snapshot()
+        results_log.flush()
+        queue.save(state)
+
+
+def search_worker(rate_limiter, session, pbar):
+    global counter
+    while not stop.is_set():
+        term = queue.take()
+        if term is None:
+            if queue.finished():
+                return
+            time.sleep(1.0) # other workers may still queue more prefixes
+            continue
+
+        results = None
+        n_exceptions = 0
+        while results is None and not stop.is_set():
+            rate_limiter.acquire()
+            try:
+                # a malformed response is retried like a failed request
+                response_results = load_podcast_search(term, session)['results']
+                if not all(isinstance(result, dict) and 'trackId' in result for result in response_results):
+                    raise ValueError(f"Malformed results for {term}")
+                results = response_results
+            except Exception as e:
+                # if we get an exception, wait a bit and try again
+
+                if n_exceptions > 5:  # if we get 6 exceptions in a row,
+                    # print stacktrace and give up on this term
+                    import traceback
+
+                    traceback.print_exc()
+                    break
+
+                time.sleep(2 ** n_exceptions)  # exponential backoff
+                n_exceptions += 1
+        if results is None:
+            if not stop.is_set():
+                queue.give_up(term)
+            continue # stopping, the prefix stays pending
+
+        for result in results:
+            results_log.add(result)
+        with counter_lock:
+            counter += 1
+            should_save = counter % 50 == 0
+
+        # queue the next terms
+        n_responses = len(results)
+        queue.done(term, n_responses)
+        tqdm.write(f"term: \"{term}\" has {n_responses} results")
+        pbar.total = queue.n_done + len(queue.pending)
         pbar.update(1)
-    
-    if counter % 50 == 0:
-        save_results()
-    counter += 1
-save_results()
 
-print(f"Found {len(results)} results.")
+        if should_save:
+            save_results()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1,
+                        help='threads searching prefixes concurrently, every source IP has one shared MAX_REQUEST_RATE budget')
+    parser.add_argument('--source_ips', nargs='*', default=[],
+                        help='local IPs to send requests from, workers are spread over them and each IP gets its own rate budget')
+    parser.add_argument('--compact', action='store_true',
+                        help=f'only write {RESULTS_LOG_PATH} to {RESULTS_PATH} for load_rss_links.py and exit')
+    args = parser.parse_args()
+    return args.workers, args.source_ips, args.compact
+
+
+def write_feedurls(path='feedurls.txt'):
+    # Seperately save list of feedUrl's for podcast downloaders,
+    # each feed once however its URL is spelled (e.g. http/https, trailing slash, feedburner)
+    feed_urls = [result['feedUrl'] for result in iter_results(RESULTS_LOG_PATH) if 'feedUrl' in result]
+    feed_index = FeedIndex(FEED_INDEX_PATH)
+    with open(path, 'w') as f:
+        for feed_url, duplicate in zip(feed_urls, feed_index.mark_duplicates(feed_urls)):
+            if not duplicate:
+                f.write(feed_url + '\n')
+    feed_index.close()
+
+
+if __name__ == '__main__':
+    n_workers, source_ips, compact = parse_args()
+
+    results_log = ResultsLog(RESULTS_LOG_PATH)
+    if compact:
+        print(f"Wrote {compact_results()} results to {RESULTS_PATH}")
+        sys.exit()
+    counter = 0
+    counter_lock = threading.Lock()
+    save_lock = threading.Lock()
+    stop = threading.Event() # set on exit, workers finish their current prefix and return
+
+    queue = PrefixQueue(QUEUE_PATH)
+
+    # one session and one rate budget per source IP, shared by the workers using that IP
+    sessions, rate_limiters = [], []
+    for source_ip in (source_ips or [None]):
+        session = requests.Session()
+        if source_ip is not None:
+            adapter = SourceAddressAdapter(source_ip)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        sessions.append(session)
+        rate_limiters.append(TokenBucket(MAX_REQUEST_RATE / 60.0, burst=1))
+
+    pbar = tqdm(initial=queue.n_done, total=queue.n_done + len(queue.pending), desc='prefixes')
+    workers = []
+    for i in range(max(n_workers, len(sessions))):
+        worker = threading.Thread(target=search_worker, args=(rate_limiters[i % len(sessions)], sessions[i % len(sessions)], pbar), daemon=True)
+        worker.start()
+        workers.append(worker)
+    try:
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(timeout=1.0) # join() with a timeout so Ctrl+C still works
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+        save_results()
 
-# Seperately save list of feedUrl's for podcast downloaders
-with open('feedurls.txt', 'w') as f:
-    for result in results:
-        f.write(result['feedUrl'] + '\n')
\ No newline at end of file
+    print(f"Found {len(results_log)} results.")
+    compact_results()
+    write_feedurls()
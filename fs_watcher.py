@@ -0,0 +1,172 @@
+import os
+import time
+import heapq
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# -----------------------------
+
+CLOSE_SETTLE_TIME = 2.0  # seconds a file must stay untouched after being closed/renamed into place
+SCAN_SETTLE_TIME = 60.0  # seconds a file found by a scan must stay untouched, it may still be open
+SCAN_INTERVAL = 60.0  # seconds between scans when inotify isn't available
+RESCAN_INTERVAL = 3600.0  # seconds between safety-net scans when inotify is available
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+# -----------------------------
+
+class Inotify:
+    """Minimal ctypes binding to Linux inotify. Raises OSError if it isn't available."""
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}  # watch descriptor -> directory
+
+    def add_watch(self, directory, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {directory}')
+        self.dirs[wd] = directory
+
+    def read_events(self, timeout):
+        """Returns [(directory, name, mask), ...], waiting up to timeout seconds for the first event."""
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        if not poller.poll(timeout * 1000):
+            return []
+        events = []
+        while True:
+            try:
+                buffer = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+                name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_IGNORED:
+                    self.dirs.pop(wd, None)  # directory was deleted
+                    continue
+                events.append((self.dirs.get(wd), os.fsdecode(name), mask))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    """
+    Finds files with one of `extensions` under root and returns each of them from poll() once it's completely written:
+    closed (or renamed into place) and untouched for CLOSE_SETTLE_TIME with inotify,
+    or unchanged for SCAN_SETTLE_TIME when it was found by scanning the tree.
+    Uses inotify on every directory under root when possible, and falls back to periodic scans.
+    Hidden directories (e.g. .git) are ignored.
+    """
+    def __init__(self, root, extensions, use_inotify=True):
+        self.root = root
+        self.extensions = set(extensions)
+        self.candidates = {}  # path -> (size, mtime, ready_at)
+        self.ready_heap = []  # (ready_at, path), entries whose ready_at no longer matches candidates are stale
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                self.inotify = None
+        self.scan_interval = RESCAN_INTERVAL if self.inotify else SCAN_INTERVAL
+        self.last_scan = -float('inf')
+
+    def is_media(self, name):
+        return os.path.splitext(name)[1] in self.extensions
+
+    def add_candidate(self, path, settle_time):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        ready_at = time.time() + settle_time
+        self.candidates[path] = (stat.st_size, stat.st_mtime, ready_at)
+        heapq.heappush(self.ready_heap, (ready_at, path))
+
+    def watch_tree(self, directory):
+        # watch every directory first, then scan, so files created in between aren't missed
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            if self.inotify is not None:
+                try:
+                    self.inotify.add_watch(root)
+                except OSError as e:
+                    if e.errno != errno.ENOSPC:
+                        raise
+                    print(f'Out of inotify watches ({e}), falling back to scanning every {SCAN_INTERVAL:.0f}s')
+                    self.inotify.close()
+                    self.inotify = None
+                    self.scan_interval = SCAN_INTERVAL
+            for file in files:
+                path = os.path.join(root, file)
+                if self.is_media(file) and path not in self.candidates:
+                    self.add_candidate(path, SCAN_SETTLE_TIME)
+
+    def poll(self, timeout=1.0):
+        """Returns the paths that became ready, waiting up to timeout seconds for filesystem events."""
+        now = time.time()
+        if now - self.last_scan >= self.scan_interval:
+            self.last_scan = now
+            self.watch_tree(self.root)
+
+        if self.inotify is not None:
+            for directory, name, mask in self.inotify.read_events(timeout):
+                if mask & IN_Q_OVERFLOW:
+                    self.last_scan = -float('inf')  # events were dropped, rescan on the next poll
+                    continue
+                if directory is None:
+                    continue
+                path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and not name.startswith('.'):
+                        self.watch_tree(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and self.is_media(name):
+                    self.add_candidate(path, CLOSE_SETTLE_TIME)
+        else:
+            time.sleep(timeout)
+
+        # a candidate is ready once its settle time passed without it changing
+        ready = []
+        now = time.time()
+        while self.ready_heap and self.ready_heap[0][0] <= now:
+            ready_at, path = heapq.heappop(self.ready_heap)
+            if path not in self.candidates or self.candidates[path][2] != ready_at:
+                continue  # stale, the file was seen again since
+            size, mtime, _ = self.candidates.pop(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # deleted or renamed
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self.add_candidate(path, SCAN_SETTLE_TIME)  # still being written
+                continue
+            ready.append(path)
+        return ready
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
@@ -1,20 +1,30 @@
-import gzip
 import requests
 import json
 import time
-import os
 import random
+import argparse
 from tqdm import tqdm
-from collections import defaultdict
-from xml.etree import cElementTree as ET
+from collections import defaultdict, Counter
+from xml.etree import ElementTree as ET
+from rss_fetcher import fetch_concurrently, make_session
+from feed_cache import FeedCache, FeedNotModified, conditional_get
+from rss_dicts_utils import SegmentWriter, iter_rss_dict_urls
+from feed_index import FeedIndex, FEED_INDEX_PATH, rss_dict_fingerprint
+import metrics
 
 # -----------------------------
 
-MAX_REQUEST_RATE = 600  # max requests per minute
+MAX_IN_FLIGHT = 256  # max requests in flight across all hosts
+MAX_PER_HOST = 8  # max requests in flight to any single host
+MAX_REQUEST_RATE = 600  # max requests per minute to any single host
+REQUEST_TIMEOUT = 1
 
 RESULTS_PATH = 'podcast_search_results_full.json'
 RSS_DICTS_NAME = 'rss_dicts/rss_dicts_chunk'
+FEED_CACHE_PATH = 'rss_dicts/feed_cache.sqlite'
 
+FEED_BYTES = metrics.counter('feed_bytes_total', 'Bytes of feed XML downloaded')
+PARSE_SECONDS = metrics.histogram('feed_parse_seconds', 'Time to parse a feed into a dict')
 
 # -----------------------------
 
@@ -39,113 +49,120 @@ def etree_to_dict(t):
     return d
 
 
-def RSS_to_dict(url):
-    # request with timeout
-    response = requests.get(url, timeout=1)
-    if response.status_code != 200:
-        raise Exception(f"Error: {response.status_code} with {url}")
-    feed_d = etree_to_dict(ET.XML(response.text))
-    return feed_d
-
-
-# split a dictionary into multiple smaller dictionaries
-def split_dictionary(d, chunk_size=10_000):
-    return [dict(list(d.items())[i:i + chunk_size]) for i in range(0, len(d), chunk_size)]
-
-
-def json_dump_zipped(d, path):
-    json_str = json.dumps(d)
-    json_bytes = json_str.encode('utf-8')
-    compressed_bytes = gzip.compress(json_bytes)
-    with open(path + '.tmp', "wb") as f:
-        f.write(compressed_bytes)
-    os.replace(path + '.tmp', path)
-
-
-def json_load_zipped(path):
-    with open(path, "rb") as f:
-        compressed_bytes = f.read()
-    json_bytes = gzip.decompress(compressed_bytes)
-    json_str = json_bytes.decode('utf-8')
-    d = json.loads(json_str)
-    return d
+class FeedStatusError(Exception):
+    """Raised for a response that isn't 200, keeps the status code for the error breakdown."""
+    def __init__(self, status_code, url):
+        super().__init__(f"Error: {status_code} with {url}")
+        self.status_code = status_code
 
 
-def save(chunk_size=10_000):
-    chunked_rss_dicts = split_dictionary(rss_dicts, chunk_size)
-    for i, rss_dict_chunk in enumerate(chunked_rss_dicts):
-        json_dump_zipped(rss_dict_chunk, f'{RSS_DICTS_NAME}_{i}.json.gz')
+def RSS_to_dict(url, session=requests, cache=None, revalidate=True, feed_index=None):
+    # request with timeout, raises FeedNotModified if the cache shows the feed hasn't changed
+    # returns (feed dict, validators), the validators go in the cache once the feed is saved
+    response, validators = conditional_get(url, session, cache, revalidate=revalidate, timeout=REQUEST_TIMEOUT)
+    FEED_BYTES.inc(len(response.content))
+    if response.status_code != 200:
+        raise FeedStatusError(response.status_code, url)
+    start = time.perf_counter()
+    feed_d = etree_to_dict(ET.XML(response.text))
+    PARSE_SECONDS.observe(time.perf_counter() - start)
+    if feed_index is not None and response.url != url and isinstance((feed_d.get('rss') or {}).get('channel'), dict):
+        # redirected, e.g. to the feed's new host or from feedburner, merged if it's a known feed
+        feed_index.merge_redirect(url, response.url, rss_dict_fingerprint(feed_d))
+    return feed_d, validators
 
 
-def load():
-    rss_dicts = {}
-    i = 0
-    while True:
-        path = f'{RSS_DICTS_NAME}_{i}.json.gz'
-        if not os.path.exists(path):
-            break
-        rss_dicts.update(json_load_zipped(path))
-        i += 1
-    return rss_dicts
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--refresh', action='store_true',
+                        help='also re-fetch feeds that are already saved, skipping any that have not changed')
+    parser.add_argument('--metrics_port', type=int, default=None, help='serve Prometheus metrics on this port')
+    parser.add_argument('--metrics_file', default=None, help='write a JSON snapshot of the metrics to this file every minute')
+    args = parser.parse_args()
+    return args.refresh, args.metrics_port, args.metrics_file
 
 
 # -----------------------------
 
 if __name__ == '__main__':
+    refresh, metrics_port, metrics_file = parse_args()
+    metrics.start(metrics_port, metrics_file)
     results = json.loads(open(RESULTS_PATH, 'r').read())
     
-    rss_dicts = load()
-    rss_links = list(rss_dicts.keys())
+    # only the urls are needed, new feeds are appended to segments instead of re-saving everything
+    rss_links = set(tqdm(iter_rss_dict_urls(RSS_DICTS_NAME), desc='reading saved urls'))
+    writer = SegmentWriter()
     
-    min_time_between_requests = 60.0 / MAX_REQUEST_RATE
-    last_request_time = 0.0
     n_exceptions = 0
+    exception_causes = Counter() # error class -> count, e.g. 'HTTP 404', 'ReadTimeout', 'ParseError'
+    n_unchanged = 0
     n_exceptions_in_a_row = 0
     counter = 0
     done = False
     
-    new_results = [result for result in results if ('feedUrl' in result) and (result['feedUrl'] not in rss_dicts)]
-    random.shuffle(new_results)
-    for result in tqdm(new_results, initial=len(rss_dicts), total=len(results), smoothing=0.0):
-        counter += 1
-        
-        # wait for time between requests
-        time_since_last_request = time.time() - last_request_time
-        if time_since_last_request < min_time_between_requests:
-            time.sleep(min_time_between_requests - time_since_last_request)
-        
-        if result['feedUrl'] in rss_links:
-            continue
-        
-        try:
-            last_request_time = time.time()
-            response_dict = RSS_to_dict(result['feedUrl'])
-            n_exceptions_in_a_row = 0
-        except Exception as e:
-            n_exceptions += 1
-            n_exceptions_in_a_row += 1
-            if n_exceptions_in_a_row > 10:
-                print(e)
-            continue
-        except KeyboardInterrupt as e:
-            raise e
-        
-        rss_dicts[result['feedUrl']] = response_dict
-        rss_links.append(result['feedUrl'])
-        
-        if counter % 40000 == 0:
-            print(f"Saving {len(rss_links)} RSS links, {n_exceptions} skipped")
-            save_start = time.time()
-            save()
-            print(f"Took {time.time() - save_start:.1f}s to save, Continuing now!")
+    # dict.fromkeys() removes duplicate urls while keeping order,
+    # and the feed index drops other spellings of feeds that are already saved or queued before fetching them
+    new_urls = list(dict.fromkeys(result['feedUrl'] for result in results if ('feedUrl' in result) and (result['feedUrl'] not in rss_links)))
+    feed_index = FeedIndex(FEED_INDEX_PATH)
+    saved_feeds = set(feed_index.feed_ids(rss_links))
+    is_duplicate = feed_index.mark_duplicates(new_urls, saved_feeds)
+    new_urls = [url for url, duplicate in zip(new_urls, is_duplicate) if not duplicate]
+    print(f"{sum(is_duplicate)} URLs skipped as other spellings of the same feeds")
+    if refresh:
+        new_urls += list(rss_links)
+    random.shuffle(new_urls)
+    
+    # only feeds we already have are revalidated, a 304 for a feed missing from rss_dicts would lose it
+    saved_links = frozenset(rss_links)
+    cache = FeedCache(FEED_CACHE_PATH)
+    session = make_session(MAX_IN_FLIGHT, MAX_PER_HOST)
+    fetch = lambda url: RSS_to_dict(url, session, cache, revalidate=url in saved_links, feed_index=feed_index)
     
-    print("Saving for the final time")
-    save()
+    # fetch many feeds at once, rate limited per host instead of globally
+    fetches = fetch_concurrently(new_urls, fetch, max_in_flight=MAX_IN_FLIGHT,
+                                 max_per_host=MAX_PER_HOST, host_rate=MAX_REQUEST_RATE)
+    n_done = 0 if refresh else len(rss_links)
+    unsaved_validators = [] # (url, validators) of the feeds in the writer's buffer, cached once they're in a segment
+    try:
+        for feed_url, result, e in tqdm(fetches, initial=n_done, total=n_done + len(new_urls), smoothing=0.0):
+            counter += 1
+            
+            if isinstance(e, FeedNotModified):
+                n_unchanged += 1
+                continue
+            if e is not None:
+                n_exceptions += 1
+                exception_causes[metrics.error_class(e)] += 1
+                n_exceptions_in_a_row += 1
+                if n_exceptions_in_a_row > 10:
+                    print(e)
+                continue
+            n_exceptions_in_a_row = 0
+            response_dict, validators = result
+            unsaved_validators.append((feed_url, validators))
+            
+            # the same channel (title and first episodes) under another URL is merged with it for the next runs
+            feed_index.add_fingerprint(feed_url, rss_dict_fingerprint(response_dict))
+            rss_links.add(feed_url)
+            if writer.add(feed_url, response_dict):
+                cache.update_many(unsaved_validators)
+                unsaved_validators = []
+                print(f"Saved segment {len(writer.manifest['segments']) - 1}, {len(rss_links)} RSS links, {n_exceptions} skipped, {n_unchanged} unchanged")
+                print(f"  skipped: {', '.join(f'{n} {cause}' for cause, n in exception_causes.most_common(5))}")
+    finally:
+        # also runs on Ctrl+C, so only a crash can lose the feeds fetched since the last segment
+        print("Saving for the final time")
+        writer.flush()
+        cache.update_many(unsaved_validators)
+        cache.close()
+        print(f"{n_exceptions} skipped: {', '.join(f'{n} {cause}' for cause, n in exception_causes.most_common())}")
     
-    # Seperately save list of feedUrl's for podcast downloaders
+    # Seperately save list of feedUrl's for podcast downloaders, each feed once
+    feed_urls = [result['feedUrl'] for result in results if 'feedUrl' in result]
     with open('feedurls.txt', 'w') as f:
-        for result in results:
-            if 'feedUrl' in result:
-                f.write(result['feedUrl'] + '\n')
+        for feed_url, duplicate in zip(feed_urls, feed_index.mark_duplicates(feed_urls)):
+            if not duplicate:
+                f.write(feed_url + '\n')
+    feed_index.close()
     
     print("Finished")
\ No newline at end of file
@@ -0,0 +1,188 @@
+import os
+import json
+import atexit
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# -----------------------------
+
+SNAPSHOT_INTERVAL = 60.0  # seconds between JSON snapshots
+MAX_SERIES = 1000  # label combinations kept per metric, the rest are counted under '_other' (e.g. per-host metrics)
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+SPEED_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)  # audio seconds encoded per wall second
+
+# -----------------------------
+
+class Metric:
+    """A metric with values per combination of label values. Safe to share between threads."""
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {}  # label values -> value
+
+    def key(self, labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        if key not in self.series and len(self.series) >= MAX_SERIES:
+            key = ('_other',) * len(self.labels)
+        return key
+
+    def label_str(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            key = self.key(labels)
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            return [f'{self.name}{self.label_str(key)} {value}' for key, value in self.series.items()]
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': dict(zip(self.labels, key)), 'value': value} for key, value in self.series.items()]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.series[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        with self.lock:
+            key = self.key(labels)
+            entry = self.series.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])  # counts per bucket (+Inf last), sum, count
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total, n) in self.series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{self.label_str(key, [("le", bound)])} {cumulative}')
+                lines.append(f'{self.name}_sum{self.label_str(key)} {total}')
+                lines.append(f'{self.name}_count{self.label_str(key)} {n}')
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': dict(zip(self.labels, key)), 'buckets': dict(zip(map(str, self.buckets + ('+Inf',)), counts)),
+                     'sum': total, 'count': n} for key, (counts, total, n) in self.series.items()]
+
+
+class Registry:
+    """All metrics of a process, by name. Asking for an existing name returns the existing metric."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def get(self, cls, name, help, labels=(), **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, labels, **kwargs)
+            return self.metrics[name]
+
+    def render(self):
+        """Prometheus text format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += [f'# HELP {metric.name} {metric.help}', f'# TYPE {metric.name} {metric.kind}']
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {'time': time.time(), 'metrics': {metric.name: metric.snapshot() for metric in metrics}}
+
+
+REGISTRY = Registry()
+
+def counter(name, help, labels=()):
+    return REGISTRY.get(Counter, name, help, labels)
+
+def gauge(name, help, labels=()):
+    return REGISTRY.get(Gauge, name, help, labels)
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.get(Histogram, name, help, labels, buckets=buckets)
+
+
+def error_class(e):
+    """Short cause of an exception for labels: 'HTTP 404' for status errors, otherwise the exception's class name."""
+    status_code = getattr(e, 'status_code', None) or getattr(getattr(e, 'response', None), 'status_code', None)
+    return f'HTTP {status_code}' if status_code else type(e).__name__
+
+# -----------------------------
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_snapshot(path, registry=REGISTRY):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+
+def start(port=None, snapshot_path=None, interval=SNAPSHOT_INTERVAL, registry=REGISTRY, host=''):
+    """
+    Serves the metrics at http://{host}:{port}/metrics if port is given,
+    and writes them to snapshot_path every interval seconds (and at exit) if it's given. Both run in background threads.
+    """
+    if port is not None:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        server.registry = registry
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    if snapshot_path is not None:
+        atexit.register(write_snapshot, snapshot_path, registry)
+
+        def snapshot_loop():
+            while True:
+                time.sleep(interval)
+                write_snapshot(snapshot_path, registry)
+        threading.Thread(target=snapshot_loop, daemon=True).start()
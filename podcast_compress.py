@@ -1,38 +1,257 @@
 import os
 import subprocess
 import time
+import heapq
+import threading
+import traceback
 import concurrent.futures
+from fs_watcher import FileWatcher
+from transcode_ledger import TranscodeLedger, LEDGER_PATH, DONE, FAILED
+import metrics
 
 # File extensions to monitor
 file_extensions = [".mp3", ".flac", ".wav", ".m4a", ".mp4"]
 
-def convert_file_to_opus(input_file_path):
-    # Build the paths to the output file
+# The output may be this much (+1 second) shorter or longer than the input before it's rejected.
+# Durations ffmpeg only estimates from the bitrate (VBR MP3s without a Xing header) can be far off,
+# those inputs are measured by demuxing them instead
+DURATION_TOLERANCE = 0.02
+
+# Files smaller than this are converted several at a time by one ffmpeg process in batch mode
+BATCH_MAX_FILE_SIZE = 32 * 2**20
+
+TRANSCODES = metrics.counter("transcodes_total", "Files converted, by status and cause of failure", ("status", "cause"))
+TRANSCODED_AUDIO = metrics.counter("transcode_audio_seconds_total", "Seconds of audio converted")
+TRANSCODED_BYTES = metrics.counter("transcode_bytes_total", "Bytes read and written by conversions", ("direction",))
+ENCODE_SPEED = metrics.histogram("transcode_speed", "Seconds of audio encoded per wall second, per ffmpeg process", buckets=metrics.SPEED_BUCKETS)
+QUEUE = metrics.gauge("transcode_queue", "Files pending and converting, and the workers allowed", ("state",))
+
+def probe_duration(path):
+    # Audio duration in seconds from ffprobe, or None if it can't be read
+    command = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", path]
+    try:
+        return float(subprocess.run(command, capture_output=True, text=True).stdout.strip())
+    except (OSError, ValueError):
+        return None
+
+def demuxed_duration(path):
+    # Audio duration in seconds from the timestamps of every packet, without decoding, or None if it can't be read.
+    # Slower than the header ffprobe reads, but exact where that is only an estimate
+    command = ["ffmpeg", "-hide_banner", "-nostdin", "-v", "error", "-stats", "-i", path, "-map", "0:a:0", "-c", "copy", "-f", "null", "-"]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, errors="replace")
+    except OSError:
+        return None
+    if result.returncode != 0 or "time=" not in result.stderr:
+        return None
+    try:
+        hours, minutes, seconds = result.stderr.rsplit("time=", 1)[1].split()[0].split(":")
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return None
+
+def parse_input_durations(ffmpeg_stderr, n_inputs):
+    # The "Duration: HH:MM:SS.ss" ffmpeg prints for each "Input #i", None where it's N/A
+    # or only estimated from the bitrate (ffmpeg warns about that just before the "Input #i" line)
+    durations = [None] * n_inputs
+    current = None
+    estimated = False
+    for line in ffmpeg_stderr.splitlines():
+        if "Estimating duration from bitrate" in line:
+            estimated = True
+        elif line.startswith("Input #"):
+            current = None if estimated else int(line[len("Input #"):].split(",")[0])
+            estimated = False
+        elif current is not None and line.strip().startswith("Duration:"):
+            try:
+                hours, minutes, seconds = line.split("Duration:")[1].split(",")[0].strip().split(":")
+                durations[current] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+            except ValueError:
+                pass
+            current = None
+    return durations
+
+def ogg_opus_duration(path):
+    # Duration of an Ogg Opus file from its last page's granule position (always 48kHz) minus the pre-skip,
+    # without starting another process. None if the file isn't a complete Ogg Opus stream.
+    try:
+        with open(path, "rb") as f:
+            head = f.read(64)
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 65536))
+            tail = f.read()
+    except OSError:
+        return None
+    opus_head = head.find(b"OpusHead")
+    last_page = tail.rfind(b"OggS")
+    if opus_head == -1 or last_page == -1 or len(tail) < last_page + 14:
+        return None
+    pre_skip = int.from_bytes(head[opus_head + 10:opus_head + 12], "little")
+    granule = int.from_bytes(tail[last_page + 6:last_page + 14], "little", signed=True)
+    return (granule - pre_skip) / 48000 if granule > 0 else None
+
+def available_workers(n_running, threads_per_job=1, max_workers=None):
+    # Cores not busy with other work, the 1-minute load average includes our own running encoders
+    n_cores = os.cpu_count() or 1
+    try:
+        other_load = max(0.0, os.getloadavg()[0] - n_running * threads_per_job)
+    except OSError:
+        other_load = 0.0
+    n_workers = max(1, int((n_cores - other_load) // threads_per_job))
+    return min(n_workers, max_workers) if max_workers else n_workers
+
+def opus_paths(input_file_path):
+    # ffmpeg writes to a temporary name until the output is validated
     output_file_path = os.path.splitext(input_file_path)[0] + ".opus"
+    return output_file_path, output_file_path + ".part"
+
+def start_conversion(input_file_path, min_age, ledger, retry_failed):
+    # Returns the input's stat if it should be converted now, or None to skip it
+    output_file_path, _ = opus_paths(input_file_path)
 
-    # Check if file has been written to in the last 60 seconds
-    last_modified = os.path.getmtime(input_file_path)
-    if time.time() - last_modified < 60:
-        return
+    # Check if file has been written to in the last min_age seconds
+    stat = os.stat(input_file_path)
+    if time.time() - stat.st_mtime < min_age:
+        return None
     
-    # Convert the input file to OPUS using ffmpeg
-    command = [
-        "ffmpeg",
-        "-i", input_file_path,
+    # Skip files the ledger already has a result for (converted again if the output went missing)
+    if ledger is not None and ledger.should_skip(input_file_path, stat, retry_failed):
+        if ledger.get(input_file_path)['status'] != DONE:
+            return None
+        if os.path.exists(output_file_path):
+            try:
+                os.remove(input_file_path) # converted before, but deleting the source failed
+            except: pass
+            return None
+    if ledger is not None:
+        ledger.start(input_file_path, stat, output_file_path)
+        # a hardlink of a file that's already converted (an episode shared by several feeds) links its output instead
+        converted = ledger.converted_link(input_file_path, stat)
+        if converted is not None and os.path.exists(converted["output_path"]):
+            try:
+                os.link(converted["output_path"], output_file_path)
+            except OSError:
+                return stat
+            ledger.finish(input_file_path, DONE, converted["output_size"], converted["duration_s"])
+            TRANSCODES.inc(status=DONE, cause="hardlink")
+            try:
+                os.remove(input_file_path)
+            except: pass
+            return None
+    return stat
+
+def opus_output_args(temp_file_path, threads=None):
+    return [
         "-ac", "1",  # mono
         "-b:a", "32k",  # 32kbps
         "-c:a", "libopus",
         "-vn",  # no video
-        "-y",  # overwrite output file
-        output_file_path
+        *(["-threads", str(threads)] if threads else []),  # keep each job to its share of the cores
+        "-f", "opus",  # the .part extension doesn't tell ffmpeg the format
+        "-y",  # overwrite a temp file left by an earlier crash
+        temp_file_path
     ]
-    subprocess.run(command)
 
-    # Delete the input file if output file exists and is not empty
-    if os.path.exists(output_file_path) and os.path.getsize(output_file_path) > 0.05 * os.path.getsize(input_file_path):
+def finish_conversion(input_file_path, stat, input_duration, returncode, ledger):
+    # Validates the output, by duration when the input's is known or can be measured, otherwise by size.
+    # Returns the seconds of audio converted, or None if it failed
+    output_file_path, temp_file_path = opus_paths(input_file_path)
+    error = cause = None
+    output_duration = None
+    if returncode != 0 or not os.path.exists(temp_file_path):
+        error, cause = f"ffmpeg exited with code {returncode}", "ffmpeg error"
+    else:
+        if input_duration is None:
+            input_duration = demuxed_duration(input_file_path)
+        if input_duration is not None:
+            output_duration = ogg_opus_duration(temp_file_path) or probe_duration(temp_file_path)
+            if output_duration is None or abs(output_duration - input_duration) > input_duration * DURATION_TOLERANCE + 1.0:
+                error, cause = f"output is {output_duration}s long, input is {input_duration}s", "wrong duration"
+        elif os.path.getsize(temp_file_path) <= 0.05 * stat.st_size:
+            error, cause = f"output is only {os.path.getsize(temp_file_path)} bytes", "output too small"
+    if error is not None:
         try:
-            os.remove(input_file_path)
+            os.remove(temp_file_path)
         except: pass
+        if ledger is not None:
+            ledger.finish(input_file_path, FAILED, error=error)
+        TRANSCODES.inc(status=FAILED, cause=cause)
+        return None
+    
+    # Only delete the input once the validated output is in place
+    os.replace(temp_file_path, output_file_path)
+    if ledger is not None:
+        ledger.finish(input_file_path, DONE, os.path.getsize(output_file_path), output_duration or input_duration)
+    TRANSCODES.inc(status=DONE)
+    TRANSCODED_AUDIO.inc(output_duration or input_duration or 0)
+    TRANSCODED_BYTES.inc(stat.st_size, direction="in")
+    TRANSCODED_BYTES.inc(os.path.getsize(output_file_path), direction="out")
+    try:
+        os.remove(input_file_path)
+    except: pass
+    return output_duration or input_duration
+
+# Returns the seconds of audio converted, or None if the file was skipped or failed
+def convert_file_to_opus(input_file_path, min_age=60, ledger=None, retry_failed=False, threads=None):
+    stat = start_conversion(input_file_path, min_age, ledger, retry_failed)
+    if stat is None:
+        return None
+    
+    # Convert the input file to OPUS using ffmpeg
+    _, temp_file_path = opus_paths(input_file_path)
+    command = ["ffmpeg", "-hide_banner", "-nostats", "-i", input_file_path] + opus_output_args(temp_file_path, threads)
+    start = time.time()
+    result = subprocess.run(command, capture_output=True, text=True, errors="replace")
+    elapsed = time.time() - start
+    input_duration = parse_input_durations(result.stderr, 1)[0]
+    seconds = finish_conversion(input_file_path, stat, input_duration, result.returncode, ledger)
+    if seconds:
+        ENCODE_SPEED.observe(seconds / max(elapsed, 1e-3))
+    return seconds
+
+# Runs function(input_file_path, *args) for one file of a batch, so an error (e.g. the file was deleted meanwhile)
+# only drops that file. The error is logged and recorded, and None is returned
+def for_one_file(function, input_file_path, ledger, *args):
+    try:
+        return function(input_file_path, *args)
+    except Exception as e:
+        print(f"Error converting {input_file_path}:")
+        traceback.print_exc()
+        if ledger is not None:
+            ledger.finish(input_file_path, FAILED, error=repr(e))
+        TRANSCODES.inc(status=FAILED, cause=metrics.error_class(e))
+        return None
+
+# Converts several files with one ffmpeg process (one input and output per file) to save the per-process startup,
+# falling back to one process per file if the batch fails. Returns the seconds of audio converted per file
+def convert_files_to_opus(input_file_paths, min_age=60, ledger=None, retry_failed=False, threads=None):
+    if len(input_file_paths) == 1:
+        return [for_one_file(convert_file_to_opus, input_file_paths[0], ledger, min_age, ledger, retry_failed, threads)]
+    stats = {path: for_one_file(start_conversion, path, ledger, min_age, ledger, retry_failed) for path in input_file_paths}
+    batch = [path for path in input_file_paths if stats[path] is not None]
+    if not batch:
+        return [None] * len(input_file_paths)
+    
+    command = ["ffmpeg", "-hide_banner", "-nostats"]
+    for path in batch:
+        command += ["-i", path]
+    for i, path in enumerate(batch):
+        command += ["-map", f"{i}:a:0"] + opus_output_args(opus_paths(path)[1], threads)
+    start = time.time()
+    result = subprocess.run(command, capture_output=True, text=True, errors="replace")
+    elapsed = time.time() - start
+    
+    if result.returncode != 0:
+        # one bad input fails the whole batch, convert the files one by one to find it
+        # (their ledger entries are still 'running', so they aren't skipped)
+        seconds = {path: for_one_file(convert_file_to_opus, path, ledger, 0, ledger, retry_failed, threads) for path in batch}
+    else:
+        input_durations = parse_input_durations(result.stderr, len(batch))
+        seconds = {path: for_one_file(finish_conversion, path, ledger, stats[path], duration, 0, ledger)
+                   for path, duration in zip(batch, input_durations)}
+        if any(seconds.values()):
+            ENCODE_SPEED.observe(sum(s for s in seconds.values() if s) / max(elapsed, 1e-3))
+    return [seconds.get(path) for path in input_file_paths]
 
 def dir_to_opus_paths(directory): # generator
     for root, dirs, files in os.walk(directory):
@@ -53,19 +272,90 @@ if __name__ == '__main__':
     import argparse
     
     parser = argparse.ArgumentParser()
-    parser.add_argument("--n_workers", default=4, type=int,
-                        help="The number of workers to run for re-encoding the audio.")
+    parser.add_argument("--n_workers", default=None, type=int,
+                        help="The most workers to run for re-encoding the audio, by default as many as there are idle cores.")
+    parser.add_argument("--threads_per_job", default=1, type=int,
+                        help="The ffmpeg threads each worker uses.")
+    parser.add_argument("--batch_size", default=1, type=int,
+                        help=f"Convert up to this many files under {BATCH_MAX_FILE_SIZE // 2**20}MB with one ffmpeg process.")
+    parser.add_argument("--retry_failed", action="store_true",
+                        help="Convert files that failed in an earlier run again, even if they haven't changed.")
+    parser.add_argument("--metrics_port", default=None, type=int,
+                        help="Serve Prometheus metrics on this port.")
+    parser.add_argument("--metrics_file", default=None,
+                        help="Write a JSON snapshot of the metrics to this file every minute.")
     args = parser.parse_args()
+    metrics.start(args.metrics_port, args.metrics_file)
     
     # Path to the directory to monitor
     directory_to_monitor = "."
     
-    # Maximum number of threads to use
-    max_workers = int(args.n_workers)
+    # Maximum number of threads to use, the number actually running follows the load average
+    max_workers = args.n_workers or max(1, (os.cpu_count() or 1) // args.threads_per_job)
+    n_workers = available_workers(0, args.threads_per_job, max_workers)
+    last_sizing = last_report = start_time = time.time()
     
-    while True:
-        # Convert all files in the target directory to OPUS
-        dir_to_opus(directory_to_monitor, max_workers=max_workers)
-        
-        # Wait for 10 seconds then check again
-        time.sleep(10)
+    # Files are queued as soon as they're completely written (inotify, or periodic scans if it's not available),
+    # and each file is only queued once while it's waiting or being converted
+    watcher = FileWatcher(directory_to_monitor, file_extensions)
+    ledger = TranscodeLedger(LEDGER_PATH)
+    pending = [] # heap of (-size, path), the biggest (longest) files start first so they don't make up the tail
+    queued = set() # pending or converting
+    in_flight = set()
+    lock = threading.Lock()
+    audio_seconds = 0.0 # converted since start
+    n_converted = 0
+    
+    def on_converted(future, paths):
+        global audio_seconds, n_converted
+        with lock:
+            in_flight.discard(future)
+            queued.difference_update(paths)
+            if future.exception():
+                e = future.exception()
+                print(f"Error converting {paths}:")
+                traceback.print_exception(type(e), e, e.__traceback__)
+            else:
+                for seconds in future.result():
+                    if seconds:
+                        audio_seconds += seconds
+                        n_converted += 1
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            for file_path in watcher.poll(timeout=0.5):
+                if file_path not in queued:
+                    try:
+                        size = os.path.getsize(file_path)
+                    except OSError:
+                        continue
+                    queued.add(file_path)
+                    heapq.heappush(pending, (-size, file_path))
+            
+            QUEUE.set(len(pending), state="pending")
+            QUEUE.set(len(in_flight), state="converting")
+            QUEUE.set(n_workers, state="workers")
+            
+            now = time.time()
+            if now - last_sizing >= 30:
+                last_sizing = now
+                n_workers = available_workers(len(in_flight), args.threads_per_job, max_workers)
+            if now - last_report >= 300:
+                last_report = now
+                wall_hours = (now - start_time) / 3600
+                print(f"{n_converted} files, {audio_seconds / 3600:.1f} audio-hours in {wall_hours:.2f} wall-hours "
+                      f"({audio_seconds / 3600 / wall_hours:.1f} audio-hours/wall-hour), {n_workers} workers, {len(pending)} pending")
+            
+            # only start as many files as there are workers, the rest wait in `pending` so the order stays longest-first
+            while pending and len(in_flight) < n_workers:
+                size, file_path = heapq.heappop(pending)
+                batch = [file_path]
+                # everything after a small file is smaller still, so small files are batched together
+                while -size < BATCH_MAX_FILE_SIZE and pending and len(batch) < args.batch_size:
+                    batch.append(heapq.heappop(pending)[1])
+                # the watcher already waited for the files to be closed/stable
+                future = executor.submit(convert_files_to_opus, batch, min_age=0, ledger=ledger,
+                                         retry_failed=args.retry_failed, threads=args.threads_per_job)
+                with lock:
+                    in_flight.add(future)
+                future.add_done_callback(lambda f, paths=batch: on_converted(f, paths))
@@ -3,58 +3,96 @@ import os
 import time
 import argparse
 import subprocess
+import concurrent.futures
 from os.path import exists
 from shutil import rmtree
-from multiprocessing import Process
-from podcast_utils import RSS_to_title, is_empty, ascii_percent, make_path_safe
-from langdetect import detect
+from podcast_utils import RSS_to_record, title_verdict, make_path_safe
+from episode_downloader import download_feed
+from episode_index import EpisodeIndex, EPISODE_INDEX_PATH
+from throttle import DownloadThrottle
+from completion_index import CompletionIndex, COMPLETION_INDEX_PATH, DONE, SKIPPED, FAILED
+from prefilter import chunk_tsv_path
+from chunk_coordinator import CoordinatorClient
+from feed_index import FeedIndex, FEED_INDEX_PATH
+from requests import RequestException
 from tqdm import tqdm
+import metrics
 
-def add_completed_url(url):
-    completed_urls.add(url)
-    with open(completed_file, 'a') as f:
-        f.write(f"{url}\n")
+COMPLETED_FILE = 'completed.txt' # only read to migrate into COMPLETION_INDEX_PATH
+BINARY_PATH = './poddl'
+LEASE_POLL_INTERVAL = 30 # seconds between asking the coordinator for work while other nodes hold the remaining feeds
+
+# recorded by the parent process, the downloads themselves run in worker processes
+FEEDS = metrics.counter('download_feeds_total', 'Feeds finished, by status and reason', ('status', 'reason'))
+FEED_SECONDS = metrics.histogram('download_feed_seconds', 'Time to download a whole feed')
+DOWNLOADED_BYTES = metrics.counter('download_bytes_total', 'Bytes of media downloaded')
+DOWNLOADED_AUDIO = metrics.counter('download_audio_seconds_total', 'Seconds of audio in the feeds downloaded')
+IN_FLIGHT = metrics.gauge('download_in_flight', 'Feeds downloading')
+THROTTLE = metrics.gauge('download_throttle', 'DownloadThrottle state: limit, paused, throughput (bytes/s), backlog and free (bytes)', ('field',))
+ETA_SECONDS = metrics.gauge('download_eta_seconds', 'Estimated time to download the rest of the chunks read so far')
 
 def run(cmd):
     with open(os.devnull, 'w') as devnull:
         subprocess.call(cmd, shell=True, stdout=devnull)
 
-# function to download a single podcast
-def download_podcast(url, progress_str):
+def dir_size(directory):
+    # leftover .part files of interrupted downloads aren't episodes
+    return sum(os.path.getsize(os.path.join(root, file)) for root, dirs, files in os.walk(directory) for file in files
+               if not file.endswith(('.part', '.part.validator')))
+
+# function to download a single podcast, runs in a worker process
+# returns (status, reason, n_bytes), the parent process records it in the completion index
+# title is given for feeds prefilter.py already checked, then the feed is only fetched if the builtin downloader needs it
+def download_podcast(url, out_dir, progress_str, binary_path=BINARY_PATH, downloader='poddl', title=None):
     try:
-        title, episode_titles = RSS_to_title(url)
-        title_is_invalid = ascii_percent(title) < 95 or len(title.strip()) < 8 or len(title.strip()) > 80
-        language_is_invalid = detect(title+' '+' '.join(episode_titles)) != 'en'
-        if title_is_invalid or language_is_invalid:
-            print(f"{progress_str} Skipping [{title}]  ({url})")
-            add_completed_url(url)
-            return
+        record = None
+        if title is None or downloader == 'builtin':
+            record = RSS_to_record(url)
+        if title is None:
+            if record.title is None:
+                raise Exception(f"Feed has no title: {url}")
+            title = record.title
+            reason = title_verdict(title, [episode.title or '' for episode in record.episodes])
+            if reason is not None:
+                print(f"{progress_str} Skipping [{title}]  ({url})")
+                return SKIPPED, reason, 0
     except Exception as e:
         print(f"{progress_str} Skipping {url} (error: {e})")
-        add_completed_url(url)
-        return
+        return FAILED, f'feed error: {e}', 0
     
     safe_title = make_path_safe(title)
     pod_dur = os.path.join(out_dir, safe_title)
     os.makedirs(pod_dur, exist_ok=True)
     
     #print(f"{progress_str} Downloading [{safe_title}]  ({url})")
-    run(f'{binary_path} "{url}" "{pod_dur}"')
-    
-    add_completed_url(url)
+    if downloader == 'builtin':
+        # reuses the feed parsed above instead of fetching it again,
+        # episodes another feed already downloaded are hardlinked from there
+        episode_index = EpisodeIndex(EPISODE_INDEX_PATH)
+        try:
+            n_ok, n_failed, _ = download_feed(record, pod_dur, episode_index=episode_index)
+        finally:
+            episode_index.close()
+        if n_failed > 0:
+            # recorded as failed so --retry_failed downloads the rest, resuming the .part files
+            return FAILED, f'episodes failed: {n_failed} of {n_ok + n_failed}', dir_size(pod_dur)
+    else:
+        run(f'{binary_path} "{url}" "{pod_dur}"')
     
     if not exists(pod_dur):
-        return
+        return FAILED, 'no episodes downloaded', 0
     
-    if is_empty(pod_dur):
+    n_bytes = dir_size(pod_dur)
+    if n_bytes == 0:
         # remove empty directory
         rmtree(pod_dur)
+        return FAILED, 'no episodes downloaded', 0
     #else:
         # convert to opus
         #print(f"{progress_str} Converting [{safe_title}]  ({url})")
         #dir_to_opus(pod_dur, max_workers=4).shutdown(wait=True)
     
-    return
+    return DONE, None, n_bytes
 
 def pretty_format_time(secs: float):
     """12386712 -> 3d:10h:17m:52s"""
@@ -72,84 +110,221 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--start_chunk', type=int, default=-1)
     parser.add_argument('--final_chunk', type=int, default=-1)
+    parser.add_argument('--max_processes', type=int, default=4, help='decides the most podcasts to download at once')
+    parser.add_argument('--min_processes', type=int, default=1, help='the podcasts downloaded at once at the start, and the fewest when throughput drops')
+    parser.add_argument('--backlog_watermark_gb', type=float, default=500.0,
+                        help='pause downloads while more than this much downloaded media is waiting for podcast_compress.py')
+    parser.add_argument('--min_free_gb', type=float, default=50.0, help='pause downloads while the disk has less free space than this')
+    parser.add_argument('--downloader', choices=['poddl', 'builtin'], default='poddl',
+                        help='poddl binary, or the built-in episode_downloader.py (resumes partial downloads)')
+    parser.add_argument('--retry_failed', action='store_true', help='download feeds that failed in earlier runs again')
+    parser.add_argument('--coordinator', default=None,
+                        help='URL of a chunk_coordinator.py to lease feeds from instead of reading --start_chunk to --final_chunk')
+    parser.add_argument('--worker_id', default=None, help='this node\'s name at the coordinator, by default hostname-pid')
+    parser.add_argument('--metrics_port', type=int, default=None, help='serve Prometheus metrics on this port')
+    parser.add_argument('--metrics_file', default=None, help='write a JSON snapshot of the metrics to this file every minute')
     args = parser.parse_args()
-    return args.start_chunk, args.final_chunk
+    return args
+
+def read_chunk(chunk_id):
+    """
+    Returns (urls, durations, titles) from a TSV chunk, or None if the chunk doesn't exist.
+    Reads the chunk prefilter.py wrote if there is one, titles are None for feeds that weren't prefiltered.
+    """
+    tsv_file = chunk_tsv_path(chunk_id, filtered=True)
+    # a _filtered list older than its chunk was made for an earlier export_lists.py plan
+    if not exists(tsv_file) or (exists(chunk_tsv_path(chunk_id))
+                                and os.path.getmtime(tsv_file) < os.path.getmtime(chunk_tsv_path(chunk_id))):
+        tsv_file = chunk_tsv_path(chunk_id)
+    if not exists(tsv_file):
+        return None
+    with open(tsv_file, 'r') as f:
+        lines = [line.strip('\r\n').split('\t') for line in f.readlines() if line.strip()]
+    urls = [line[0].strip() for line in lines]
+    durations = [float(line[2]) for line in lines]
+    titles = [line[3] or None if len(line) > 3 else None for line in lines] # empty for feeds prefilter.py couldn't load
+    return urls, durations, titles
+
+def iter_chunks(start_chunk, final_chunk):
+    """Yields (chunk_id, urls, durations, titles), reading the next chunk's TSV in the background while the current one runs."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader:
+        next_chunk = reader.submit(read_chunk, start_chunk)
+        chunk_id = start_chunk
+        while chunk_id <= final_chunk:
+            chunk = next_chunk.result()
+            if chunk is None:
+                print(f"Chunk {chunk_id} not found, stopping")
+                return
+            if chunk_id + 1 <= final_chunk:
+                next_chunk = reader.submit(read_chunk, chunk_id + 1)
+            yield (chunk_id, *chunk)
+            chunk_id += 1
 
 if __name__ == '__main__':
-    start_chunk, final_chunk = parse_args()
-    assert start_chunk != -1 and final_chunk != -1, "--start_chunk={int} and --final_chunk={int} must be specified"
+    args = parse_args()
+    start_chunk, final_chunk, max_processes, downloader = args.start_chunk, args.final_chunk, args.max_processes, args.downloader
+    assert args.coordinator or (start_chunk != -1 and final_chunk != -1), \
+        "--start_chunk={int} and --final_chunk={int}, or --coordinator={url} must be specified"
     if final_chunk == -1:
         final_chunk = float('inf')
     
-    completed_file = 'completed.txt'
-    binary_path = './poddl'
-    max_processes = 4 # decides how many connections to make at once
+    metrics.start(args.metrics_port, args.metrics_file)
     
-    # load completed URLs (to skip)
-    completed_urls = set()
-    if exists(completed_file):
-        with open(completed_file, 'r') as f:
-            completed_urls = set(l.strip() for l in f.readlines())
+    # check the binary exists
+    if downloader == 'poddl' and not exists(BINARY_PATH):
+        raise ValueError("Invalid path to poddl.exe binary")
     
-    current_chunk = start_chunk
-    while current_chunk <= final_chunk:
-        tsv_file = os.path.join('podcast_tsv_chunks', f'podcast_over1hr_english_chunk_{current_chunk}.tsv')
-        out_dir = f'podcasts_chunk_{current_chunk}'
-        
-        # check the binary exists
-        if not exists(binary_path):
-            raise ValueError("Invalid path to poddl.exe binary")
-        
-        # read URLs from file
-        print(f"Reading {tsv_file}")
-        with open(tsv_file, 'r') as f:
-            lines = f.readlines()
-            urls = [line.strip().split('\t')[0] for line in lines]
-            durations = [float(line.strip().split('\t')[2]) for line in lines]
-        total_duration = sum(durations)
-        
-        # init progress bar / eta
-        ETA_str = ''
-        pbar = tqdm(
-            initial=sum(durations[id] for id, url in enumerate(urls) if url in completed_urls),
-            total=total_duration, desc=f'downloading chunk {current_chunk}', smoothing=0.0)
-        
-        # run poddl.exe on each URL that hasn't been completed, limited by max_processes
-        active_processes = []
-        active_process_durations = []
-        for id, url in enumerate(urls):
-            if url in completed_urls:
-                #print(f"Skipping {url} (already processed)")
-                continue
-            else:
-                start_time = time.time()
-                duration = durations[id]
+    # feeds already done, skipped or failed (to skip), only this process writes to it
+    completion_index = CompletionIndex(COMPLETION_INDEX_PATH)
+    n_migrated = completion_index.migrate_completed_file(COMPLETED_FILE)
+    if n_migrated:
+        print(f"Imported {n_migrated} URLs from {COMPLETED_FILE} into {COMPLETION_INDEX_PATH}")
+    
+    # other spellings of the same feed (see feed_index.py) count as the same feed
+    feed_index = FeedIndex(FEED_INDEX_PATH)
+    seen_feeds = set() # feed IDs submitted by this run
+    
+    def is_finished(url):
+        return any(completion_index.is_finished(alias, args.retry_failed) for alias in feed_index.aliases(url))
+    
+    # with --coordinator, feeds come from leases and results are reported back (as well as recorded here)
+    coordinator = CoordinatorClient(args.coordinator, args.worker_id) if args.coordinator else None
+    
+    in_flight = {} # future -> (chunk_id, url, duration, unit_id, start time)
+    pbars = {} # chunk_id -> progress bar, a single one under None with --coordinator
+    chunk_n_left = {} # chunk_id -> number of podcasts submitted but not finished
+    start_time = time.time()
+    audio_done = 0.0 # seconds of audio finished by this run
+    
+    def on_done(future):
+        # update progress on each completion instead of polling the workers
+        global audio_done
+        chunk_id, url, duration, unit_id, started = in_flight.pop(future)
+        try:
+            status, reason, n_bytes = future.result()
+        except Exception as e:
+            print(f"Error downloading {url}: {e}")
+            status, reason, n_bytes = FAILED, f'error: {e}', 0
+        completion_index.record(url, status, reason, n_bytes)
+        audio_done += duration
+        FEEDS.inc(status=status, reason=(reason or '').split(':')[0])
+        FEED_SECONDS.observe(time.time() - started)
+        DOWNLOADED_BYTES.inc(n_bytes)
+        DOWNLOADED_AUDIO.inc(duration)
+        IN_FLIGHT.set(len(in_flight))
+        if coordinator is not None:
+            coordinator.complete(unit_id, status, reason, n_bytes)
+            pbars[None].update(duration)
+            return
+        pbars[chunk_id].update(duration)
+        chunk_n_left[chunk_id] -= 1
+        if chunk_n_left[chunk_id] == 0 and chunk_id != current_chunk:
+            pbars.pop(chunk_id).close()
+    
+    def wait_for_any(timeout=None):
+        if not in_flight:
+            time.sleep(timeout)
+            return
+        done, _ = concurrent.futures.wait(in_flight, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            on_done(future)
+    
+    # scales the number of running downloads to throughput and pauses them when the disk or compression backlog fills up
+    throttle = DownloadThrottle(min(args.min_processes, max_processes), max_processes,
+                                args.backlog_watermark_gb * 2**30, args.min_free_gb * 2**30)
+    
+    def eta():
+        # the audio left in the chunks read so far at this run's rate, None until something finished
+        remaining = sum(pbar.total - pbar.n for chunk_id, pbar in pbars.items() if chunk_id is not None)
+        if not audio_done or not remaining:
+            return None
+        return remaining * (time.time() - start_time) / audio_done
+    
+    def wait_for_slot():
+        was_paused = throttle.paused
+        while len(in_flight) >= throttle.allowed():
+            if throttle.paused and not was_paused:
+                tqdm.write(f"Pausing downloads ({throttle.status()})")
+            was_paused = throttle.paused
+            wait_for_any(timeout=throttle.interval)
+        if was_paused:
+            tqdm.write(f"Resuming downloads ({throttle.status()})")
+        for field in ('limit', 'paused', 'throughput', 'backlog', 'free'):
+            THROTTLE.set(float(getattr(throttle, field) or 0), field=field)
+        eta_secs = eta()
+        ETA_SECONDS.set(eta_secs or 0)
+        eta_str = f', {pretty_format_time(eta_secs)}' if eta_secs is not None else ''
+        pbars[current_chunk].set_postfix_str(throttle.status() + eta_str, refresh=False)
+    
+    current_chunk = None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_processes) as executor:
+        if coordinator is not None:
+            # lease as many feeds as there are free slots, until the coordinator has none left that aren't finished
+            pbars[None] = tqdm(desc=f'downloading as {coordinator.worker}', unit='s', smoothing=0.0)
+            while True:
+                wait_for_slot()
+                n_free = throttle.allowed() - len(in_flight) # allowed() can drop (pause) after wait_for_slot()
+                if n_free <= 0:
+                    continue
+                try:
+                    units = coordinator.lease(n_free)
+                except (RequestException, ValueError) as e:
+                    tqdm.write(f"Coordinator unreachable ({e}), retrying in {LEASE_POLL_INTERVAL}s")
+                    wait_for_any(timeout=LEASE_POLL_INTERVAL)
+                    continue
+                for unit in units:
+                    chunk_id, url = unit['chunk_id'], unit['url']
+                    if is_finished(url):
+                        # finished here before, e.g. by a run that didn't use the coordinator
+                        entry = next(completion_index.get(alias) for alias in feed_index.aliases(url)
+                                     if completion_index.is_finished(alias, args.retry_failed))
+                        coordinator.complete(unit['id'], entry['status'], entry['reason'], entry['n_bytes'])
+                        continue
+                    if feed_index.mark_duplicates([url], seen_feeds)[0]:
+                        coordinator.complete(unit['id'], SKIPPED, 'duplicate feed', 0)
+                        continue
+                    future = executor.submit(download_podcast, url, f'podcasts_chunk_{chunk_id}', f'[chunk {chunk_id}]',
+                                             downloader=downloader, title=unit['title'])
+                    in_flight[future] = (chunk_id, url, unit['duration'], unit['id'], time.time())
+                    IN_FLIGHT.set(len(in_flight))
+                if not units:
+                    if not in_flight and coordinator.remaining == 0:
+                        break
+                    # the rest is leased to other nodes, their leases may still expire
+                    wait_for_any(timeout=LEASE_POLL_INTERVAL)
+        else:
+            for chunk_id, urls, durations, titles in iter_chunks(start_chunk, final_chunk):
+                # close the previous chunk's progress bar if it already finished
+                if current_chunk is not None and chunk_n_left[current_chunk] == 0:
+                    pbars.pop(current_chunk).close()
+                current_chunk = chunk_id
+                out_dir = f'podcasts_chunk_{chunk_id}'
+                chunk_n_left[chunk_id] = 0
+                skip = [duplicate or is_finished(url) for url, duplicate in zip(urls, feed_index.mark_duplicates(urls, seen_feeds))]
                 
-                # wait for a process to finish
-                while len(active_processes) >= max_processes:
-                    for i, p in list(enumerate(active_processes)):
-                        p_dur = active_process_durations[i]
-                        if not p.is_alive():
-                            # process finished, remove it from the list
-                            active_processes.remove(p)
-                            active_process_durations.remove(p_dur)
-                            #total_duration_done += p_dur
-                            pbar.update(p_dur)
-                            
-                            # calculate new ETA
-                            #total_time_elapsed = time.time() - start_time
-                            #time_per_duration = total_time_elapsed / total_duration_done
-                            #remaining_duration = total_duration - total_duration_done
-                            #ETA_secs = remaining_duration * time_per_duration
-                            #ETA_str = pretty_format_time(ETA_secs)
-                            break
-                    #print(f"{ETA_str}  {total_duration_done/total_duration*100:.2f}%  {len(active_processes)}/{max_processes}  {url}", end='\r')
-                    time.sleep(0.1)
+                # init progress bar
+                pbars[chunk_id] = tqdm(
+                    initial=sum(duration for duration, skipped in zip(durations, skip) if skipped),
+                    total=sum(durations), desc=f'downloading chunk {chunk_id}', smoothing=0.0)
                 
-                # add a new process
-                p = Process(target=download_podcast, args=(url,ETA_str))
-                p.start()
-                active_processes.append(p)
-                active_process_durations.append(duration)
+                # run poddl on each URL that hasn't been completed, as many at once as the throttle allows,
+                # starting the next chunk while the previous chunk's last podcasts finish
+                for url, duration, title, skipped in zip(urls, durations, titles, skip):
+                    if skipped:
+                        continue
+                    wait_for_slot()
+                    future = executor.submit(download_podcast, url, out_dir, f'[chunk {chunk_id}]', downloader=downloader, title=title)
+                    in_flight[future] = (chunk_id, url, duration, None, time.time())
+                    IN_FLIGHT.set(len(in_flight))
+                    chunk_n_left[chunk_id] += 1
         
-        current_chunk += 1
\ No newline at end of file
+        current_chunk = None
+        while in_flight:
+            wait_for_any()
+        for pbar in pbars.values():
+            pbar.close()
+    
+    for status, (n_feeds, n_bytes) in sorted(completion_index.totals().items()):
+        print(f"{status}: {n_feeds} feeds, {n_bytes / 2**30:.1f}GB")
+    completion_index.close()
+    feed_index.close()
\ No newline at end of file
@@ -3,8 +3,16 @@ import re
 from glob import glob
 
 import requests
+import numpy as np
+from typing import NamedTuple, Optional
 from collections import defaultdict
-from xml.etree import cElementTree as ET
+from xml.etree import ElementTree as ET
+from langdetect import detect, DetectorFactory
+from langdetect.lang_detect_exception import LangDetectException
+
+DetectorFactory.seed = 0 # make detect() deterministic, so cached verdicts match a fresh run
+
+REQUEST_TIMEOUT = 30 # seconds to connect and between reads, the same as prefilter.py's fetches
 
 def etree_to_dict(t):
     d = {t.tag: {} if t.attrib else None}
@@ -26,35 +34,150 @@ def etree_to_dict(t):
             d[t.tag] = text
     return d
 
-def RSS_to_dict(url):
-    response = requests.get(url)
+def RSS_to_dict(url, timeout=REQUEST_TIMEOUT):
+    response = requests.get(url, timeout=timeout)
     if response.status_code != 200:
         raise Exception(f"Error: {response.status_code} with {url}")
     feed_d = etree_to_dict(ET.XML(response.text))
     return feed_d
 
+class Episode(NamedTuple):
+    title: Optional[str]
+    duration: Optional[str] # raw itunes:duration, e.g. '00:00:00', '00:00' or '3600'
+    enclosure_url: Optional[str]
+    enclosure_length: Optional[int]
+    guid: Optional[str]
+    pub_date: Optional[str] # 'Wed, 01 Jan 2020 00:00:00 +0000'
+
+class FeedRecord(NamedTuple):
+    title: Optional[str]
+    language: Optional[str]
+    description: Optional[str]
+    episodes: list # [Episode, ...]
+
+def _local_name(tag):
+    # '{http://www.itunes.com/dtds/podcast-1.0.dtd}duration' -> 'duration'
+    return tag.rsplit('}', 1)[-1]
+
+def _text(elem):
+    return elem.text.strip() if elem.text else ''
+
+def parse_feed(source):
+    """
+    Streams an RSS feed from a file path or binary file object with iterparse
+    and returns a FeedRecord with only the fields downstream code uses.
+    Each <item> is cleared as soon as it's been read, so memory doesn't grow with the number of episodes.
+    """
+    channel = {}
+    episodes = []
+    item = None
+    stack = []
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            if elem.tag == 'item' and len(stack) == 3:
+                item = {}
+            continue
+        stack.pop()
+        depth = len(stack)
+        if item is not None and depth == 3:
+            # direct child of <item>, plain tags take priority over namespaced ones (title vs itunes:title)
+            name = _local_name(elem.tag)
+            if name == 'enclosure':
+                length = elem.get('length', '').strip()
+                item['enclosure_url'] = elem.get('url')
+                item['enclosure_length'] = int(length) if length.isdigit() else None
+            elif name in ('title', 'duration', 'guid', 'pubDate'):
+                if name not in item or elem.tag == name:
+                    item[name] = _text(elem)
+        elif item is not None and depth == 2:
+            episodes.append(Episode(item.get('title'), item.get('duration'), item.get('enclosure_url'),
+                                    item.get('enclosure_length'), item.get('guid'), item.get('pubDate')))
+            item = None
+            elem.clear()
+            stack[-1].remove(elem)
+        elif depth == 2 and elem.tag in ('title', 'language', 'description'):
+            channel[elem.tag] = _text(elem)
+            elem.clear()
+    if 'title' not in channel and not episodes:
+        raise ValueError("No RSS <channel> found")
+    return FeedRecord(channel.get('title'), channel.get('language'), channel.get('description'), episodes)
+
+def RSS_to_record(url, session=requests, timeout=REQUEST_TIMEOUT):
+    # parse while downloading instead of holding the whole response and element tree in memory
+    with session.get(url, stream=True, timeout=timeout) as response:
+        if response.status_code != 200:
+            raise Exception(f"Error: {response.status_code} with {url}")
+        response.raw.decode_content = True # undo gzip/deflate transfer encoding
+        return parse_feed(response.raw)
+
 def RSS_to_title(url):
-    rss_dict = RSS_to_dict(url)
-    main_title = rss_dict['rss']['channel']['title']
-    episodes = rss_dict['rss']['channel']['item']
-    if type(episodes) is list:
-        episode_titles = [item.get('title', '') for item in episodes]
-    elif type(episodes) is dict:
-        episode_titles = [episodes.get('title', '')]
-    else:
-        raise Exception(f"Unexpected type for episodes: {type(episodes)}")
-    return main_title, episode_titles
+    record = RSS_to_record(url)
+    if record.title is None:
+        raise Exception(f"Feed has no title: {url}")
+    episode_titles = [episode.title or '' for episode in record.episodes]
+    return record.title, episode_titles
 
 def ascii_percent(text):
     """
     Calculates the percentage of ASCII characters in a string.
     """
-    ascii_count = 0
-    for char in text:
-        if ord(char) < 128:
-            ascii_count += 1
+    # encoding drops the non-ASCII characters in C instead of looping over every character
+    ascii_count = len(text.encode('ascii', 'ignore'))
     return (ascii_count / len(text)) * 100
 
+def _segment_sums(values, lengths):
+    # sums of values over consecutive segments of the given lengths
+    cumsum = np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+    ends = np.cumsum(lengths)
+    return cumsum[ends] - cumsum[ends - lengths]
+
+def text_features(texts, strip=True):
+    """
+    Batch text checks for a list of strings, returns a dict of arrays with one value per string:
+    'n_chars', 'n_ascii' and 'ascii_percent' (NaN for empty strings).
+    Pure ASCII strings (most titles) are found with str.isascii(), the rest are encoded as one
+    fixed width UTF-32 buffer so their characters are counted with numpy instead of a Python loop.
+    """
+    if strip:
+        texts = [text.strip() for text in texts]
+    n_chars = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    n_ascii = n_chars.copy()
+    non_ascii = np.flatnonzero(~np.fromiter(map(str.isascii, texts), dtype=bool, count=len(texts)))
+    if len(non_ascii):
+        code_points = np.frombuffer(''.join([texts[i] for i in non_ascii]).encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+        n_ascii[non_ascii] = _segment_sums(code_points < 0x80, n_chars[non_ascii])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent = np.where(n_chars > 0, n_ascii / n_chars * 100, np.nan)
+    return {'n_chars': n_chars, 'n_ascii': n_ascii, 'ascii_percent': percent}
+
+def ascii_percents(texts):
+    """Batch ascii_percent(), NaN for empty strings."""
+    return text_features(texts, strip=False)['ascii_percent']
+
+def title_verdicts(titles, episode_titles):
+    """
+    Returns a list with None for each podcast that should be downloaded, or the reason to skip it:
+    'invalid title' (too short/long or under 95% ASCII) or 'not english' (langdetect on the podcast and episode titles).
+    Length and ASCII checks run as one batch, langdetect only runs on the titles that pass them.
+    Not thread-safe, langdetect gives wrong answers when its first calls run concurrently.
+    """
+    features = text_features(titles)
+    title_ok = (features['n_chars'] >= 8) & (features['n_chars'] <= 80) & (features['ascii_percent'] >= 95)
+    verdicts = []
+    for title, ep_titles, ok in zip(titles, episode_titles, title_ok):
+        if not ok:
+            verdicts.append('invalid title')
+            continue
+        try:
+            verdicts.append(None if detect(title.strip() + ' ' + ' '.join(ep_titles)) == 'en' else 'not english')
+        except LangDetectException: # no letters to detect from
+            verdicts.append('not english')
+    return verdicts
+
+def title_verdict(title, episode_titles):
+    return title_verdicts([title], [episode_titles])[0]
+
 def is_empty(directory):
     return glob(os.path.join(directory, '**', '*.*'), recursive=True) == 0
 
@@ -0,0 +1,149 @@
+import os
+import time
+import sqlite3
+import argparse
+import threading
+from tqdm import tqdm
+from podcast_utils import RSS_to_record, title_verdicts
+from rss_fetcher import fetch_concurrently, make_session
+from feed_index import canonical_url
+
+# -----------------------------
+
+MAX_IN_FLIGHT = 64  # max feeds fetched at once across all hosts
+MAX_PER_HOST = 4
+REQUEST_TIMEOUT = 30
+
+VERDICTS_PATH = 'prefilter_verdicts.sqlite'
+TSV_DIR = 'podcast_tsv_chunks'
+
+OK = 'ok'
+SKIP = 'skip'
+ERROR = 'error'  # fetch/parse failed, checked again on the next run
+
+# -----------------------------
+
+def chunk_tsv_path(chunk_id, filtered=False):
+    name = f'podcast_over1hr_english_chunk_{chunk_id}' + ('_filtered' if filtered else '')
+    return os.path.join(TSV_DIR, name + '.tsv')
+
+
+class VerdictCache:
+    """
+    Persistent per-feed prefilter verdicts (ok/skip/error, reason and podcast title), keyed by feed_index.canonical_url().
+    Safe to share between threads.
+    """
+    def __init__(self, path=VERDICTS_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS verdicts ('
+                              'url TEXT PRIMARY KEY, verdict TEXT, reason TEXT, title TEXT, checked REAL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.rekey()
+
+    def rekey(self):
+        """One-time rewrite of verdicts keyed by the old normalized URL to canonical_url(), the latest check wins."""
+        with self.lock:
+            if self.conn.execute('SELECT 1 FROM meta WHERE key = ?', ('keys:canonical_url',)).fetchone():
+                return
+            self.conn.execute('BEGIN IMMEDIATE')
+            rows = self.conn.execute('SELECT * FROM verdicts ORDER BY checked').fetchall()
+            self.conn.execute('DELETE FROM verdicts')
+            self.conn.executemany('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)',
+                                  ((canonical_url(url),) + tuple(rest) for url, *rest in rows))
+            self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('keys:canonical_url', str(time.time())))
+            self.conn.execute('COMMIT')
+
+    def get(self, url):
+        with self.lock:
+            row = self.conn.execute('SELECT verdict, reason, title FROM verdicts WHERE url = ?',
+                                    (canonical_url(url),)).fetchone()
+        return None if row is None else dict(zip(['verdict', 'reason', 'title'], row))
+
+    def set(self, url, verdict, reason, title):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)',
+                              (canonical_url(url), verdict, reason, title, time.time()))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def feed_verdicts(feeds):
+    """[(title, episode_titles), ...] -> [(verdict, reason, title), ...], with one title_verdicts() call for the batch."""
+    titled = [(title, episode_titles) for title, episode_titles in feeds if title is not None]
+    reasons = iter(title_verdicts([title for title, _ in titled], [episode_titles for _, episode_titles in titled]))
+    verdicts = []
+    for title, _ in feeds:
+        if title is None:
+            verdicts.append((SKIP, 'no title', None))
+        else:
+            reason = next(reasons)
+            verdicts.append(((SKIP if reason else OK), reason, title))
+    return verdicts
+
+
+def prefilter_chunk(chunk_id, cache, session, max_in_flight=MAX_IN_FLIGHT):
+    """
+    Writes the feeds of a TSV chunk that pass title_verdicts() to its _filtered.tsv, with the podcast title as a 4th column.
+    Feeds that failed to load are kept with an empty title, only skipped feeds are left out.
+    Only feeds without a cached ok/skip verdict are fetched. Returns {verdict: n_feeds}.
+    """
+    with open(chunk_tsv_path(chunk_id), 'r') as f:
+        lines = [line.strip() for line in f if line.strip()]
+    urls = [line.split('\t')[0] for line in lines]
+    todo = list(dict.fromkeys(url for url in urls if (cache.get(url) or {}).get('verdict') in (None, ERROR)))
+
+    # feeds are fetched and parsed in threads, verdicts are computed here since langdetect isn't thread-safe,
+    # all at once when the chunk is fetched. Only the titles are kept until then, not the whole records
+    fetches = fetch_concurrently(todo, lambda url: RSS_to_record(url, session, timeout=REQUEST_TIMEOUT),
+                                 max_in_flight=max_in_flight, max_per_host=MAX_PER_HOST)
+    fetched = []  # [(url, title, episode_titles), ...]
+    for url, record, e in tqdm(fetches, total=len(todo), desc=f'prefiltering chunk {chunk_id}', smoothing=0.0):
+        if e is not None:
+            cache.set(url, ERROR, str(e), None)
+        else:
+            fetched.append((url, record.title, [episode.title or '' for episode in record.episodes]))
+    verdicts = feed_verdicts([(title, episode_titles) for _, title, episode_titles in fetched])
+    for (url, _, _), verdict in zip(fetched, verdicts):
+        cache.set(url, *verdict)
+
+    counts = {OK: 0, SKIP: 0, ERROR: 0}
+    with open(chunk_tsv_path(chunk_id, filtered=True) + '.tmp', 'w') as f:
+        for line, url in zip(lines, urls):
+            entry = cache.get(url)
+            counts[entry['verdict']] += 1
+            if entry['verdict'] == OK:
+                f.write(f"{line}\t{' '.join(entry['title'].split())}\n")
+            elif entry['verdict'] == ERROR:
+                f.write(f"{line}\t\n") # no title, so podcast_download.py fetches and checks it itself
+    os.replace(chunk_tsv_path(chunk_id, filtered=True) + '.tmp', chunk_tsv_path(chunk_id, filtered=True))
+    return counts
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start_chunk', type=int, required=True)
+    parser.add_argument('--final_chunk', type=int, required=True)
+    parser.add_argument('--max_in_flight', type=int, default=MAX_IN_FLIGHT, help='feeds fetched at once')
+    args = parser.parse_args()
+    return args.start_chunk, args.final_chunk, args.max_in_flight
+
+
+if __name__ == '__main__':
+    start_chunk, final_chunk, max_in_flight = parse_args()
+    cache = VerdictCache(VERDICTS_PATH)
+    session = make_session(max_in_flight, MAX_PER_HOST)
+    try:
+        for chunk_id in range(start_chunk, final_chunk + 1):
+            if not os.path.exists(chunk_tsv_path(chunk_id)):
+                print(f"Chunk {chunk_id} not found, stopping")
+                break
+            counts = prefilter_chunk(chunk_id, cache, session, max_in_flight)
+            print(f"chunk {chunk_id}: {counts[OK]} kept, {counts[SKIP]} skipped, {counts[ERROR]} failed to load")
+    finally:
+        cache.close()
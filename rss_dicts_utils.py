@@ -0,0 +1,234 @@
+import gzip
+import json
+import os
+import time
+
+# -----------------------------
+
+RSS_DICTS_NAME = 'rss_dicts/rss_dicts_chunk'
+SEGMENTS_NAME = 'rss_dicts/rss_dicts_segment'
+MANIFEST_PATH = 'rss_dicts/manifest.json'
+SEGMENT_SIZE = 10_000  # feeds per segment
+
+READ_BLOCK_SIZE = 1 << 20  # 1MB of decompressed text per read
+
+# -----------------------------
+
+_decoder = json.JSONDecoder()
+
+
+def _skip_whitespace(buf, pos):
+    while pos < len(buf) and buf[pos] in ' \t\n\r':
+        pos += 1
+    return pos
+
+
+def iter_json_object_items(f, block_size=READ_BLOCK_SIZE):
+    """
+    Yields (key, value) pairs from a text file containing a single top-level JSON object,
+    parsing one value at a time so only the current value (plus one read block) is held in memory.
+    """
+    buf = f.read(block_size)
+    eof = not buf
+    pos = _skip_whitespace(buf, 0)
+    while pos >= len(buf) and not eof:
+        more = f.read(block_size)
+        eof = not more
+        buf += more
+        pos = _skip_whitespace(buf, pos)
+    if pos >= len(buf) or buf[pos] != '{':
+        raise ValueError("Expected a JSON object")
+    pos += 1
+    expect_comma = False
+    while True:
+        # make sure the next structural character is in the buffer
+        pos = _skip_whitespace(buf, pos)
+        while pos >= len(buf) and not eof:
+            buf = buf[pos:] + f.read(block_size)
+            eof = len(buf) == 0
+            pos = _skip_whitespace(buf, 0)
+        if pos >= len(buf):
+            raise ValueError("Unexpected end of JSON object")
+        if buf[pos] == '}':
+            return
+        if expect_comma:
+            if buf[pos] != ',':
+                raise ValueError(f"Expected ',' at position {pos}")
+            pos += 1
+
+        # parse '"key": value', reading more data until the whole value is buffered.
+        # Parsed text is only dropped from the buffer when more is read, so each value costs O(its size)
+        while True:
+            try:
+                key_start = _skip_whitespace(buf, pos)
+                key, key_end = _decoder.raw_decode(buf, key_start)
+                colon = _skip_whitespace(buf, key_end)
+                if colon >= len(buf) or buf[colon] != ':':
+                    raise json.JSONDecodeError("Expected ':'", buf, colon)
+                value, value_end = _decoder.raw_decode(buf, _skip_whitespace(buf, colon + 1))
+                # a number cut off by the end of the buffer still decodes ('1.5' as '1' or '1.'), so the value
+                # only counts as complete once the ',' or '}' after it is buffered too
+                after = _skip_whitespace(buf, value_end)
+                if (after < len(buf) and buf[after] in ',}') or eof:
+                    break
+            except (json.JSONDecodeError, ValueError):
+                if eof:
+                    raise
+            # grow the buffer geometrically so large values aren't re-parsed too many times
+            more = f.read(max(block_size, len(buf) - pos))
+            eof = not more
+            buf = buf[pos:] + more
+            pos = 0
+        yield key, value
+        pos = value_end
+        expect_comma = True
+
+
+def rss_dicts_paths(rss_dicts_name=RSS_DICTS_NAME):
+    """Returns the paths of every rss_dicts chunk, in chunk order."""
+    paths = []
+    i = 0
+    while True:
+        path = f'{rss_dicts_name}_{i}.json.gz'
+        if not os.path.exists(path):
+            break
+        paths.append(path)
+        i += 1
+    return paths
+
+
+def iter_rss_dicts_chunk(path, block_size=READ_BLOCK_SIZE):
+    """Yields (feed_url, rss_dict) pairs from a single rss_dicts chunk file."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        yield from iter_json_object_items(f, block_size)
+
+
+# -----------------------------
+# Append-only segments. New feeds are written once to a new segment file
+# and listed in a small manifest, instead of re-saving every chunk.
+# Each line of a segment is '{json url}\t{json rss_dict}', so urls can be read without parsing the dicts.
+
+def load_manifest(manifest_path=MANIFEST_PATH):
+    if not os.path.exists(manifest_path):
+        return {'segments': []}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def segment_paths(manifest_path=MANIFEST_PATH):
+    manifest_dir = os.path.dirname(manifest_path)
+    return [os.path.join(manifest_dir, segment['path']) for segment in load_manifest(manifest_path)['segments']]
+
+
+def iter_segment(path, urls_only=False):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            url_json, rss_dict_json = line.split('\t', 1)
+            yield json.loads(url_json), None if urls_only else json.loads(rss_dict_json)
+
+
+class SegmentWriter:
+    """
+    Buffers new feeds and writes every segment_size of them to a new segment, then adds it to the manifest.
+    Checkpoint cost is proportional to the new data, and a crash only loses the feeds still in the buffer.
+    """
+    def __init__(self, segments_name=SEGMENTS_NAME, manifest_path=MANIFEST_PATH, segment_size=SEGMENT_SIZE):
+        self.segments_name = segments_name
+        self.manifest_path = manifest_path
+        self.segment_size = segment_size
+        self.manifest = load_manifest(manifest_path)
+        self.lines = []
+
+    def add(self, feed_url, rss_dict):
+        """Returns True if this filled and wrote a segment."""
+        # store the serialized line rather than the dict, it uses much less memory
+        self.lines.append(json.dumps(feed_url) + '\t' + json.dumps(rss_dict) + '\n')
+        if len(self.lines) >= self.segment_size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if not self.lines:
+            return
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        # never reuse a segment id, even if a segment was written but the manifest wasn't updated
+        i = len(self.manifest['segments'])
+        while os.path.exists(f'{self.segments_name}_{i}.jsonl.gz'):
+            i += 1
+        path = f'{self.segments_name}_{i}.jsonl.gz'
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+            f.writelines(self.lines)
+        os.replace(path + '.tmp', path)
+
+        self.manifest['segments'].append({
+            'path': os.path.relpath(path, os.path.dirname(self.manifest_path) or '.'),
+            'n_feeds': len(self.lines),
+            'time': time.time(),
+        })
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+        self.lines = []
+
+# -----------------------------
+
+def archive_paths(rss_dicts_name=RSS_DICTS_NAME, manifest_path=MANIFEST_PATH):
+    """Returns every file of the archive in read order, the legacy chunks then the segments."""
+    return rss_dicts_paths(rss_dicts_name) + segment_paths(manifest_path)
+
+
+def superseded_urls(paths):
+    """
+    Returns {path: urls to skip in that file}. A feed re-fetched by a later segment (load_rss_links.py --refresh)
+    supersedes every earlier copy, so each feed is read once, from the latest file it's in.
+    Only the urls of segments are scanned, once each, the legacy chunks never overlap each other.
+    Every legacy chunk gets the same set, the urls of all segments.
+    """
+    latest = {}  # url -> index of the last segment it's in
+    urls_by_path = {}
+    for i, path in enumerate(paths):
+        if path.endswith('.jsonl.gz'):
+            urls_by_path[path] = [url for url, _ in iter_segment(path, urls_only=True)]
+            for url in urls_by_path[path]:
+                latest[url] = i
+    segment_urls = frozenset(latest)
+    skip = {}
+    for i, path in enumerate(paths):
+        if path in urls_by_path:
+            skip[path] = {url for url in urls_by_path.pop(path) if latest[url] != i}
+        else:
+            skip[path] = segment_urls
+    return skip
+
+
+def iter_archive_file(path, skip=frozenset()):
+    """Yields (feed_url, rss_dict) pairs from a legacy chunk or a segment, leaving out urls in skip."""
+    items = iter_segment(path) if path.endswith('.jsonl.gz') else iter_rss_dicts_chunk(path)
+    for feed_url, rss_dict in items:
+        if feed_url not in skip:
+            yield feed_url, rss_dict
+
+
+def iter_rss_dicts(rss_dicts_name=RSS_DICTS_NAME, n_chunks='all', manifest_path=MANIFEST_PATH):
+    """
+    Yields (feed_url, rss_dict) pairs from every rss_dicts chunk and segment, one feed at a time.
+    Memory use stays constant regardless of how many chunks exist.
+    """
+    paths = archive_paths(rss_dicts_name, manifest_path)
+    if n_chunks != 'all':
+        paths = paths[:n_chunks]
+    skip = superseded_urls(paths)
+    for path in paths:
+        yield from iter_archive_file(path, skip[path])
+
+
+def iter_rss_dict_urls(rss_dicts_name=RSS_DICTS_NAME, manifest_path=MANIFEST_PATH):
+    """Yields the url of every feed in the archive, segments are read without parsing their dicts."""
+    for path in archive_paths(rss_dicts_name, manifest_path):
+        if path.endswith('.jsonl.gz'):
+            for url, _ in iter_segment(path, urls_only=True):
+                yield url
+        else:
+            for url, _ in iter_rss_dicts_chunk(path):
+                yield url
@@ -0,0 +1,139 @@
+import time
+import heapq
+import threading
+import concurrent.futures
+from collections import deque, defaultdict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# -----------------------------
+
+MAX_IN_FLIGHT = 256  # max requests in flight across all hosts
+MAX_PER_HOST = 8  # max requests in flight to any single host
+HOST_RATE = 60  # max requests per minute to any single host
+HOST_BURST = 4  # requests a host can receive back-to-back before HOST_RATE kicks in
+
+FETCH_SECONDS = metrics.histogram('fetch_seconds', 'Time from sending a feed request to its result, per host', ('host',))
+FETCHES = metrics.counter('fetches_total', 'Feeds fetched, by result (ok or the error class)', ('result',))
+FETCH_IN_FLIGHT = metrics.gauge('fetch_in_flight', 'Feed requests in flight')
+FETCH_QUEUED = metrics.gauge('fetch_queued_hosts', 'Hosts with feeds waiting, by state', ('state',))
+
+# -----------------------------
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, with bursts of up to `burst` requests."""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self, now=None):
+        """Takes a token if one is available. Returns 0.0 on success, otherwise the seconds until one is."""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Blocks until a token is available. Safe to share between threads."""
+        while True:
+            with self.lock:
+                delay = self.try_acquire()
+            if delay == 0.0:
+                return
+            time.sleep(delay)
+
+
+def url_host(url):
+    return urlsplit(url.strip()).hostname or ''
+
+
+def make_session(max_in_flight=MAX_IN_FLIGHT, max_per_host=MAX_PER_HOST):
+    # one shared pool of keep-alive connections, up to max_per_host per host
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max(1000, max_in_flight), pool_maxsize=max_per_host)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_concurrently(urls, fetch_fn, max_in_flight=MAX_IN_FLIGHT, max_per_host=MAX_PER_HOST,
+                       host_rate=HOST_RATE, host_burst=HOST_BURST):
+    """
+    Calls fetch_fn(url) for every url on a thread pool, keeping up to max_in_flight calls running at once.
+    Each host gets its own token bucket of host_rate requests per minute, so a slow or strict host
+    only throttles its own urls. Hosts are served round-robin.
+    Yields (url, result, exception) in completion order, exception is None on success.
+    """
+    queues = {}  # host -> deque of urls still to fetch
+    for url in urls:
+        queues.setdefault(url_host(url), deque()).append(url)
+    buckets = {}
+    ready = deque(queues.keys())  # hosts that may be able to send now
+    sleeping = []  # heap of (wake_time, host) for rate limited hosts
+    saturated = set()  # hosts with max_per_host requests in flight
+    host_in_flight = defaultdict(int)
+    in_flight = {}  # future -> (url, host, start time)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while ready or sleeping or saturated or in_flight:
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                ready.append(heapq.heappop(sleeping)[1])
+
+            # submit as many requests as the limits allow
+            while ready and len(in_flight) < max_in_flight:
+                host = ready.popleft()
+                if host_in_flight[host] >= max_per_host:
+                    saturated.add(host)
+                    continue
+                if host not in buckets:
+                    buckets[host] = TokenBucket(host_rate / 60.0, host_burst)
+                delay = buckets[host].try_acquire(now)
+                if delay > 0.0:
+                    heapq.heappush(sleeping, (now + delay, host))
+                    continue
+                url = queues[host].popleft()
+                in_flight[executor.submit(fetch_fn, url)] = (url, host, time.monotonic())
+                host_in_flight[host] += 1
+                if queues[host]:
+                    ready.append(host)
+                else:
+                    del queues[host]
+
+            FETCH_IN_FLIGHT.set(len(in_flight))
+            FETCH_QUEUED.set(len(ready), state='ready')
+            FETCH_QUEUED.set(len(sleeping), state='rate_limited')
+            FETCH_QUEUED.set(len(saturated), state='saturated')
+            
+            timeout = max(0.0, sleeping[0][0] - now) if sleeping else None
+            if not in_flight:
+                time.sleep(timeout or 0.0)
+                continue
+            done, _ = concurrent.futures.wait(in_flight, timeout=timeout,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                url, host, start = in_flight.pop(future)
+                FETCH_SECONDS.observe(time.monotonic() - start, host=host)
+                host_in_flight[host] -= 1
+                if host in saturated:
+                    saturated.remove(host)
+                    ready.append(host)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    FETCHES.inc(result=metrics.error_class(e))
+                    yield url, None, e
+                else:
+                    FETCHES.inc(result='ok')
+                    yield url, result, None
+    FETCH_IN_FLIGHT.set(0)
@@ -0,0 +1,122 @@
+import os
+import time
+import shutil
+import threading
+from glob import glob
+from podcast_compress import file_extensions
+
+# -----------------------------
+
+UPDATE_INTERVAL = 30.0  # seconds between concurrency adjustments
+BACKLOG_SCAN_INTERVAL = 120.0  # seconds between walks of the download folders, in a background thread
+MIN_GAIN = 0.05  # keep adding downloads while each one raises throughput by at least 5%
+MAX_LOSS = 0.20  # halve the downloads when throughput falls by more than 20%
+RESUME_FRACTION = 0.8  # resume once the backlog is back under 80% of the watermark
+
+# -----------------------------
+
+def received_bytes():
+    """
+    Total bytes received on all non-loopback interfaces, or None if /proc/net/dev isn't available.
+    This is host-wide, so other traffic on the machine counts as download throughput too.
+    """
+    if not os.path.exists('/proc/net/dev'):
+        return None
+    total = 0
+    with open('/proc/net/dev', 'r') as f:
+        for line in f.readlines()[2:]:
+            interface, _, counters = line.partition(':')
+            if interface.strip() != 'lo':
+                total += int(counters.split()[0])
+    return total
+
+
+def backlog_bytes(pattern='podcasts_chunk_*'):
+    """Size of the downloaded media podcast_compress.py hasn't converted yet, including partial downloads."""
+    total = 0
+    for chunk_dir in glob(pattern):
+        for root, dirs, files in os.walk(chunk_dir):
+            for file in files:
+                name = file[:-len('.part')] if file.endswith('.part') else file
+                if os.path.splitext(name)[1] in file_extensions:
+                    try:
+                        total += os.path.getsize(os.path.join(root, file))
+                    except OSError:
+                        pass  # converted or renamed while walking
+    return total
+
+
+class DownloadThrottle:
+    """
+    Decides how many podcasts may download at once.
+    Concurrency starts at min_limit, grows by one per interval while it keeps raising the host's received bytes/s
+    and is halved when they drop (AIMD). Without /proc/net/dev there are no measurements and it stays at max_limit.
+    Downloads pause while free disk space is under min_free_bytes or the uncompressed backlog is over backlog_watermark.
+    The backlog is measured by walking the download folders in a background thread, it reads as 0 until the first walk ends.
+    """
+    def __init__(self, min_limit, max_limit, backlog_watermark, min_free_bytes, path='.',
+                 interval=UPDATE_INTERVAL, backlog_interval=BACKLOG_SCAN_INTERVAL):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = min_limit
+        self.backlog_watermark = backlog_watermark
+        self.min_free_bytes = min_free_bytes
+        self.path = path
+        self.interval = interval
+        self.backlog_interval = backlog_interval
+        self.paused = False
+        self.throughput = None  # bytes/s over the last interval
+        self.backlog = 0
+        self.last_update = self.last_bytes_time = time.time()
+        self.last_bytes = received_bytes()
+        if self.last_bytes is None:
+            self.limit = max_limit
+        # the walk can take minutes on a big archive, the scheduler only reads its latest result
+        threading.Thread(target=self.backlog_loop, daemon=True).start()
+        self.check_disk(self.last_update)
+
+    def backlog_loop(self):
+        while True:
+            self.backlog = backlog_bytes(os.path.join(self.path, 'podcasts_chunk_*'))
+            time.sleep(self.backlog_interval)
+
+    def allowed(self, now=None):
+        """Returns how many downloads may be in flight right now, 0 while paused."""
+        now = time.time() if now is None else now
+        if now - self.last_update >= self.interval:
+            self.update(now)
+        return 0 if self.paused else self.limit
+
+    def check_disk(self, now):
+        self.free = shutil.disk_usage(self.path).free
+
+        # pause on either watermark, resume with some headroom so it doesn't flap
+        if self.free < self.min_free_bytes or self.backlog > self.backlog_watermark:
+            self.paused = True
+        elif self.paused and self.free > self.min_free_bytes * 1.2 and self.backlog < self.backlog_watermark * RESUME_FRACTION:
+            self.paused = False
+
+    def update(self, now):
+        self.last_update = now
+        self.check_disk(now)
+        n_bytes = received_bytes()
+        if n_bytes is None or self.last_bytes is None:
+            return  # no throughput measurements on this platform, keep max_limit
+        throughput = (n_bytes - self.last_bytes) / max(now - self.last_bytes_time, 1e-6)
+        self.last_bytes, self.last_bytes_time = n_bytes, now
+        if throughput < 0:
+            return  # interface counters were reset
+        if self.paused:
+            self.throughput = throughput
+            return
+        if self.throughput is None or throughput > self.throughput * (1 + MIN_GAIN):
+            self.limit = min(self.limit + 1, self.max_limit)
+        elif throughput < self.throughput * (1 - MAX_LOSS):
+            self.limit = max(self.limit // 2, self.min_limit)
+        self.throughput = throughput
+
+    def status(self):
+        # short summary for the progress bar
+        throughput = f'{self.throughput / 2**20:.1f}MB/s' if self.throughput is not None else '?'
+        state = 'paused' if self.paused else f'{self.limit} downloads'
+        return f'{state}, {throughput}, backlog {self.backlog / 2**30:.0f}GB, free {self.free / 2**30:.0f}GB'
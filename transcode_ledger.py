@@ -0,0 +1,85 @@
+import os
+import time
+import sqlite3
+import threading
+
+# -----------------------------
+
+LEDGER_PATH = 'transcode_ledger.sqlite'
+
+RUNNING = 'running'  # left behind if the process died mid-conversion, converted again
+DONE = 'done'
+FAILED = 'failed'  # skipped until the input file changes, or with --retry_failed
+
+# -----------------------------
+
+class TranscodeLedger:
+    """
+    Persistent record of every conversion podcast_compress.py attempted:
+    input path, size and mtime, output path and size, audio duration, status and error.
+    Safe to share between threads.
+    """
+    def __init__(self, path=LEDGER_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                              'input_path TEXT PRIMARY KEY, input_size INTEGER, input_mtime REAL, '
+                              'output_path TEXT, output_size INTEGER, duration_s REAL, '
+                              'status TEXT, error TEXT, started REAL, finished REAL)')
+            # (device, inode) finds conversions of the other hardlinks of a file (see episode_index.py)
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(jobs)')]
+            if 'input_dev' not in columns:
+                self.conn.execute('ALTER TABLE jobs ADD COLUMN input_dev INTEGER')
+                self.conn.execute('ALTER TABLE jobs ADD COLUMN input_inode INTEGER')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_inode ON jobs (input_inode, input_dev)')
+
+    def get(self, input_path):
+        with self.lock:
+            row = self.conn.execute('SELECT input_size, input_mtime, output_path, output_size, duration_s, status, error '
+                                    'FROM jobs WHERE input_path = ?', (input_path,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['input_size', 'input_mtime', 'output_path', 'output_size', 'duration_s', 'status', 'error'], row))
+
+    def should_skip(self, input_path, stat, retry_failed=False):
+        """True if this exact input (same size and mtime) already converted, or failed and retry_failed is False."""
+        entry = self.get(input_path)
+        if entry is None or (entry['input_size'], entry['input_mtime']) != (stat.st_size, stat.st_mtime):
+            return False
+        return entry['status'] == DONE or (entry['status'] == FAILED and not retry_failed)
+
+    def converted_link(self, input_path, stat):
+        """Returns the ledger entry (with 'input_path') of a converted hardlink of this exact input, or None."""
+        with self.lock:
+            row = self.conn.execute('SELECT input_path, output_path, output_size, duration_s FROM jobs '
+                                    'WHERE input_inode = ? AND input_dev = ? AND input_size = ? AND input_mtime = ? '
+                                    'AND status = ? AND input_path != ?',
+                                    (stat.st_ino, stat.st_dev, stat.st_size, stat.st_mtime, DONE, input_path)).fetchone()
+        return None if row is None else dict(zip(['input_path', 'output_path', 'output_size', 'duration_s'], row))
+
+    def start(self, input_path, stat, output_path):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO jobs (input_path, input_size, input_mtime, output_path, status, started, '
+                              'input_dev, input_inode) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (input_path, stat.st_size, stat.st_mtime, output_path, RUNNING, time.time(), stat.st_dev, stat.st_ino))
+
+    def finish(self, input_path, status, output_size=None, duration_s=None, error=None):
+        with self.lock:
+            self.conn.execute('UPDATE jobs SET status = ?, output_size = ?, duration_s = ?, error = ?, finished = ? '
+                              'WHERE input_path = ?', (status, output_size, duration_s, error, time.time(), input_path))
+
+    def totals(self):
+        """Returns {status: (n_jobs, input_bytes, output_bytes, duration_s)}."""
+        with self.lock:
+            rows = self.conn.execute('SELECT status, COUNT(*), COALESCE(SUM(input_size), 0), COALESCE(SUM(output_size), 0), '
+                                     'COALESCE(SUM(duration_s), 0) FROM jobs GROUP BY status').fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()